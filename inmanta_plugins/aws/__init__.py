@@ -16,15 +16,24 @@
     Contact: code@inmanta.com
 """
 
+import abc
+import base64
 import binascii
+import collections
+import concurrent.futures
+import copy
+import hashlib
 import json
 import logging
 import os
+import random
 import re
+import threading
 import time
 
 import boto3
 import botocore
+import botocore.config
 from inmanta import const
 from inmanta.agent.handler import (
     CRUDHandler,
@@ -85,26 +94,1512 @@ def long_to_bytes(val, endianness="big"):
     return s
 
 
-@plugin
-def get_api_id(provider: "aws::Provider", api_name: "string") -> "string":
-    access_key = provider.access_key
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        encoded_length = bytes([length])
+    else:
+        encoded_length = long_to_bytes(length)
+        encoded_length = bytes([0x80 | len(encoded_length)]) + encoded_length
+    return bytes([tag]) + encoded_length + content
+
+
+def key_fingerprint(public_key):
+    """
+    Compute the fingerprint EC2 reports for a public key in OpenSSH format that was imported: the md5 of the DER
+    encoded public key for rsa keys and the base64 encoded sha256 of the key for ed25519 keys. Returns None for
+    other key types.
+    """
+    try:
+        key_type, blob = public_key.split()[:2]
+        blob = base64.b64decode(blob)
+    except ValueError:
+        return None
+
+    if key_type == "ssh-ed25519":
+        return base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip("=")
+
+    if key_type != "ssh-rsa":
+        return None
+
+    # The key is a sequence of length prefixed fields: the key type, e and n
+    fields = []
+    offset = 0
+    while offset + 4 <= len(blob):
+        length = int.from_bytes(blob[offset : offset + 4], "big")
+        fields.append(blob[offset + 4 : offset + 4 + length])
+        offset += 4 + length
+    if len(fields) < 3:
+        return None
+
+    # The ssh mpints have the same encoding as DER integers
+    _, e, n = fields[:3]
+    rsa_key = _der(0x30, _der(0x02, n) + _der(0x02, e))
+    algorithm = _der(
+        0x30, _der(0x06, bytes.fromhex("2a864886f70d010101")) + b"\x05\x00"
+    )
+    digest = hashlib.md5(
+        _der(0x30, algorithm + _der(0x03, b"\x00" + rsa_key))
+    ).hexdigest()
+    return ":".join(digest[i : i + 2] for i in range(0, len(digest), 2))
+
+
+def get_credentials(access_key, secret_key):
+    """
+    Resolve the credentials of a provider, falling back to the environment when they are not set in the model.
+    """
     if access_key is None:
         access_key = os.environ.get("AWS_ACCESS_KEY")
     if access_key is None:
         raise Exception("AWS_ACCESS_KEY has to be provided as an environment variable.")
 
-    secret_key = provider.secret_key
     if secret_key is None:
         secret_key = os.environ.get("AWS_SECRET_KEY")
     if secret_key is None:
         raise Exception("AWS_SECRET_KEY has to be provided as an environment variable.")
 
-    session = boto3.Session(
-        region_name=provider.region,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
+    return access_key, secret_key
+
+
+class ClientPool:
+    """
+    Process wide pool of boto3 clients and resources.
+
+    Creating a session and loading the service models of a client costs more than most API calls. The pool keeps
+    one session per (region, access key) and hands out the same client for every (region, access key, service), so
+    all handlers share the HTTP connection pool of that client. Botocore clients are thread safe, boto3 resources
+    are not: resources are cached per thread on top of the shared session.
+
+    When the secret key of an access key changes, the session and every client and resource built on it are
+    re-created.
+    """
+
+    def __init__(self, max_pool_connections=50):
+        self._config = botocore.config.Config(max_pool_connections=max_pool_connections)
+        self._lock = threading.Lock()
+        # (region, access_key) -> [secret_key, session, generation]
+        self._sessions = {}
+        # (region, access_key, service) -> (generation, client)
+        self._clients = {}
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.renewals = 0
+
+    def _get_session(self, region, access_key, secret_key):
+        """
+        Get the session entry for these credentials. The caller must hold the lock.
+        """
+        entry = self._sessions.get((region, access_key))
+        if entry is not None and entry[0] == secret_key:
+            return entry
+
+        generation = 0
+        if entry is not None:
+            generation = entry[2] + 1
+            self.renewals += 1
+            LOGGER.debug(
+                "Credentials of access key %s changed, re-creating its AWS clients",
+                access_key,
+            )
+
+        session = boto3.Session(
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+        )
+        entry = [secret_key, session, generation]
+        self._sessions[(region, access_key)] = entry
+        return entry
+
+    def get_client(self, region, access_key, secret_key, service):
+        """
+        Get a client for the given service. The client is shared between all threads.
+        """
+        key = (region, access_key, service)
+        with self._lock:
+            _, session, generation = self._get_session(region, access_key, secret_key)
+            cached = self._clients.get(key)
+            if cached is not None and cached[0] == generation:
+                self.hits += 1
+                return cached[1]
+
+            self.misses += 1
+            client = session.client(service, config=self._config)
+            self._clients[key] = (generation, client)
+            return client
+
+    def get_resource(self, region, access_key, secret_key, service):
+        """
+        Get a boto3 resource for the given service. Resources are not thread safe, so each thread gets its own.
+        """
+        key = (region, access_key, service)
+        resources = getattr(self._local, "resources", None)
+        if resources is None:
+            resources = {}
+            self._local.resources = resources
+
+        with self._lock:
+            _, session, generation = self._get_session(region, access_key, secret_key)
+            cached = resources.get(key)
+            if cached is not None and cached[0] == generation:
+                self.hits += 1
+                return cached[1]
+
+            self.misses += 1
+            resource = session.resource(service, config=self._config)
+
+        resources[key] = (generation, resource)
+        return resource
+
+    def stats(self):
+        """
+        Return the hit, miss and renewal counters of the pool.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "renewals": self.renewals}
+
+
+CLIENT_POOL = ClientPool()
+
+
+class ProviderScoped:
+    """
+    Base class for state that is shared by all handlers that deploy resources with the same provider.
+
+    There is one instance per class and (region, access key). The credentials and the cache ttl are refreshed every
+    time a handler retrieves the instance, so the instance always uses the latest configuration of its provider.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self):
+        self.credentials = None
+        self.ttl = 0
+
+    @classmethod
+    def for_provider(cls, credentials, ttl):
+        key = (cls, credentials[0], credentials[1])
+        with ProviderScoped._instances_lock:
+            instance = ProviderScoped._instances.get(key)
+            if instance is None:
+                instance = cls()
+                ProviderScoped._instances[key] = instance
+
+        instance.credentials = credentials
+        instance.ttl = ttl
+        return instance
+
+    def get_client(self, service):
+        return CLIENT_POOL.get_client(*self.credentials, service)
+
+
+# kind -> (describe operation, result key, id key, id filter, name filter)
+EC2_KINDS = {
+    "instances": (
+        "describe_instances",
+        "Reservations",
+        "InstanceId",
+        "instance-id",
+        "tag:Name",
+    ),
+    "volumes": ("describe_volumes", "Volumes", "VolumeId", "volume-id", "tag:Name"),
+    "subnets": ("describe_subnets", "Subnets", "SubnetId", "subnet-id", "tag:Name"),
+    "vpcs": ("describe_vpcs", "Vpcs", "VpcId", "vpc-id", "tag:Name"),
+    "security_groups": (
+        "describe_security_groups",
+        "SecurityGroups",
+        "GroupId",
+        "group-id",
+        "group-name",
+    ),
+    "internet_gateways": (
+        "describe_internet_gateways",
+        "InternetGateways",
+        "InternetGatewayId",
+        "internet-gateway-id",
+        "tag:Name",
+    ),
+}
+
+# The maximum number of values in a single describe filter
+MAX_FILTER_VALUES = 200
+
+
+def describe_ec2(client, kind, filter_name=None, values=None, extra_filters=()):
+    """
+    Page through the describe call of the given kind of EC2 object. When a filter is given, its values are split
+    over as many calls as needed.
+    """
+    operation, result_key, _, _, _ = EC2_KINDS[kind]
+    paginator = client.get_paginator(operation)
+
+    if filter_name is None:
+        calls = [list(extra_filters)]
+    else:
+        calls = [
+            [{"Name": filter_name, "Values": values[i : i + MAX_FILTER_VALUES]}]
+            + list(extra_filters)
+            for i in range(0, len(values), MAX_FILTER_VALUES)
+        ]
+
+    for filters in calls:
+        args = {"Filters": filters} if filters else {}
+        for page in paginator.paginate(**args):
+            for item in page[result_key]:
+                if kind == "instances":
+                    yield from item["Instances"]
+                else:
+                    yield item
+
+
+def ec2_object_name(kind, item):
+    """
+    Get the name inmanta uses for an EC2 object: the group name of a security group, the Name tag otherwise.
+    """
+    if kind == "security_groups":
+        return item["GroupName"]
+    for tag in item.get("Tags") or []:
+        if tag["Key"] == "Name":
+            return tag["Value"]
+    return None
+
+
+class _InventoryIndex:
+    """
+    The indexed describe results of one kind of EC2 object
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.taken_at = None
+        self.by_id = {}
+        self.by_name = {}
+        # instance id -> ids of the objects attached to it
+        self.attached = {}
+        self.stale_names = set()
+        self.stale_ids = set()
+        # name -> time it was last fetched on its own or in a batch
+        self.name_fetched = {}
+        # name -> time a handler last registered it, kept when the index is cleared
+        self.registered = {}
+
+    def clear(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.attached = {}
+        self.stale_names = set()
+        self.stale_ids = set()
+        self.name_fetched = {}
+
+    def add(self, object_id, item):
+        self.remove(object_id)
+        self.by_id[object_id] = item
+        for tag in item.get("Tags") or []:
+            if tag["Key"] == "Name":
+                self.by_name.setdefault(tag["Value"], set()).add(object_id)
+        for attachment in item.get("Attachments") or []:
+            if "InstanceId" in attachment:
+                self.attached.setdefault(attachment["InstanceId"], set()).add(object_id)
+
+    def remove(self, object_id):
+        item = self.by_id.pop(object_id, None)
+        if item is None:
+            return
+        for tag in item.get("Tags") or []:
+            if tag["Key"] == "Name":
+                self.by_name.get(tag["Value"], set()).discard(object_id)
+        for attachment in item.get("Attachments") or []:
+            if "InstanceId" in attachment:
+                self.attached.get(attachment["InstanceId"], set()).discard(object_id)
+
+
+class EC2Inventory(ProviderScoped):
+    """
+    A snapshot of the EC2 objects in a region, shared by all handlers of the agent.
+
+    Instead of sending a filtered describe call for every resource, the inventory pages through the describe call
+    of a kind once and indexes the result on id and Name tag. This snapshot is reused until it is older than the
+    cache ttl of the provider. Handlers mark the objects they create or delete as stale, so the next lookup of such
+    an object refreshes only that object. With a ttl of 0 every lookup is sent to the API directly.
+
+    Lookups by name do not need the snapshot of the whole region: handlers register the names of the resources
+    they are going to read, and the first lookup of an expired name fetches all registered names of that kind with
+    multi-value tag:Name filters. The number of describe calls then grows with the number of resource types
+    instead of the number of resources.
+    """
+
+    # Names that were not registered again for this number of seconds are no longer fetched in the batch
+    REGISTRATION_RETENTION = 3600
+
+    def __init__(self):
+        ProviderScoped.__init__(self)
+        self._indexes = {kind: _InventoryIndex() for kind in EC2_KINDS}
+
+    def _describe(self, kind, filter_name=None, values=None):
+        return describe_ec2(self.get_client("ec2"), kind, filter_name, values)
+
+    def _is_expired(self, index):
+        return index.taken_at is None or time.time() - index.taken_at > self.ttl
+
+    def _ensure_fresh(self, kind, index):
+        """
+        Make sure the snapshot of this kind is not expired. The caller must hold the lock of the index.
+        """
+        if not self._is_expired(index):
+            return
+
+        id_key = EC2_KINDS[kind][2]
+        index.clear()
+        for item in self._describe(kind):
+            index.add(item[id_key], item)
+        index.taken_at = time.time()
+
+    def _refresh_names(self, kind, index, names):
+        id_key = EC2_KINDS[kind][2]
+        now = time.time()
+        for name in names:
+            for object_id in list(index.by_name.get(name, ())):
+                index.remove(object_id)
+            index.stale_names.discard(name)
+            index.name_fetched[name] = now
+
+        for item in self._describe(kind, "tag:Name", list(names)):
+            index.add(item[id_key], item)
+
+    def _is_name_expired(self, index, name):
+        if name in index.stale_names:
+            return True
+        fetched = index.name_fetched.get(name)
+        return fetched is None or time.time() - fetched > self.ttl
+
+    def _fetch_batch(self, kind, index):
+        """
+        Fetch all registered names of this kind that are expired, in as few calls as possible.
+        """
+        now = time.time()
+        for name, registered in list(index.registered.items()):
+            if now - registered > self.REGISTRATION_RETENTION:
+                del index.registered[name]
+
+        names = [
+            name for name in index.registered if self._is_name_expired(index, name)
+        ]
+        if names:
+            self._refresh_names(kind, index, names)
+
+    def register(self, kind, name):
+        """
+        Register the name of a resource that is going to be read, so it is fetched in the same batch as the other
+        names of its kind.
+        """
+        index = self._indexes[kind]
+        with index.lock:
+            index.registered[name] = time.time()
+
+    def _refresh_ids(self, kind, index, object_ids):
+        _, _, id_key, id_filter, _ = EC2_KINDS[kind]
+        for object_id in object_ids:
+            index.remove(object_id)
+            index.stale_ids.discard(object_id)
+
+        for item in self._describe(kind, id_filter, list(object_ids)):
+            index.add(item[id_key], item)
+
+    def get(self, kind, name):
+        """
+        Get the description of all objects of the given kind with the given Name tag.
+        """
+        if self.ttl <= 0:
+            return list(self._describe(kind, "tag:Name", [name]))
+
+        index = self._indexes[kind]
+        with index.lock:
+            index.registered[name] = time.time()
+            if not self._is_expired(index):
+                # The snapshot of the whole region is still fresh
+                if name in index.stale_names:
+                    self._refresh_names(kind, index, [name])
+            elif self._is_name_expired(index, name):
+                self._fetch_batch(kind, index)
+            return [index.by_id[i] for i in index.by_name.get(name, ())]
+
+    def get_by_id(self, kind, object_id):
+        """
+        Get the description of the object of the given kind with the given id, or None when it does not exist.
+        """
+        if self.ttl <= 0:
+            items = list(self._describe(kind, EC2_KINDS[kind][3], [object_id]))
+            return items[0] if items else None
+
+        index = self._indexes[kind]
+        with index.lock:
+            self._ensure_fresh(kind, index)
+            if object_id in index.stale_ids or object_id not in index.by_id:
+                self._refresh_ids(kind, index, [object_id])
+            return index.by_id.get(object_id)
+
+    def get_many(self, kind, object_ids):
+        """
+        Get the description of the objects of the given kind with the given ids, as a dict indexed on id. When the
+        snapshot is expired, only the requested objects are fetched, in a single call.
+        """
+        object_ids = list(set(object_ids))
+        index = self._indexes[kind]
+        if self.ttl > 0:
+            with index.lock:
+                if not self._is_expired(index):
+                    missing = [
+                        i
+                        for i in object_ids
+                        if i in index.stale_ids or i not in index.by_id
+                    ]
+                    if missing:
+                        self._refresh_ids(kind, index, missing)
+                    return {i: index.by_id[i] for i in object_ids if i in index.by_id}
+
+        _, _, id_key, id_filter, _ = EC2_KINDS[kind]
+        if not object_ids:
+            return {}
+        return {
+            item[id_key]: item for item in self._describe(kind, id_filter, object_ids)
+        }
+
+    def _flush_stale(self, kind, index):
+        if index.stale_names:
+            self._refresh_names(kind, index, list(index.stale_names))
+        if index.stale_ids:
+            self._refresh_ids(kind, index, list(index.stale_ids))
+
+    def get_attached(self, kind, instance_id):
+        """
+        Get the description of all objects of the given kind that are attached to the given instance.
+        """
+        if self.ttl <= 0:
+            return list(self._describe(kind, "attachment.instance-id", [instance_id]))
+
+        index = self._indexes[kind]
+        with index.lock:
+            self._ensure_fresh(kind, index)
+            self._flush_stale(kind, index)
+            return [index.by_id[i] for i in index.attached.get(instance_id, ())]
+
+    def all(self, kind):
+        """
+        Get the description of all objects of the given kind.
+        """
+        if self.ttl <= 0:
+            return list(self._describe(kind))
+
+        index = self._indexes[kind]
+        with index.lock:
+            self._ensure_fresh(kind, index)
+            self._flush_stale(kind, index)
+            return list(index.by_id.values())
+
+    def invalidate(self, kind, name=None, object_id=None):
+        """
+        Mark an object as changed, so the next lookup fetches it again.
+        """
+        index = self._indexes[kind]
+        with index.lock:
+            if name is not None:
+                index.stale_names.add(name)
+            if object_id is not None:
+                index.stale_ids.add(object_id)
+
+
+class NameResolver(ProviderScoped):
+    """
+    Memoizes which ids belong to the name of an EC2 object, and which name belongs to an id.
+
+    Names that are not cached yet are resolved together in a single describe call. Entries expire after the cache
+    ttl of the provider and the least recently used entries are evicted when the resolver holds more than
+    MAX_ENTRIES entries. Handlers invalidate the objects they create or delete.
+    """
+
+    MAX_ENTRIES = 4096
+
+    # Only resolve instances that are not terminated yet
+    EXTRA_FILTERS = {
+        "instances": [
+            {
+                "Name": "instance-state-name",
+                "Values": [
+                    "pending",
+                    "running",
+                    "shutting-down",
+                    "stopping",
+                    "stopped",
+                ],
+            }
+        ]
+    }
+
+    def __init__(self):
+        ProviderScoped.__init__(self)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def resolve(self, kind, names, scope=None):
+        """
+        Get the ids of the objects with the given names, as a dict with a list of ids for every name. A security
+        group name is only unique within a VPC: use the id of the VPC as scope to restrict the lookup to that VPC.
+        """
+        result = {}
+        missing = []
+        for name in sorted(set(names)):
+            ids = self._get(("name", kind, scope, name))
+            if ids is None:
+                missing.append(name)
+            else:
+                result[name] = list(ids)
+
+        if not missing:
+            return result
+
+        _, _, id_key, _, name_filter = EC2_KINDS[kind]
+        extra_filters = list(self.EXTRA_FILTERS.get(kind, []))
+        if scope is not None:
+            extra_filters.append({"Name": "vpc-id", "Values": [scope]})
+
+        found = {name: [] for name in missing}
+        items = describe_ec2(
+            self.get_client("ec2"), kind, name_filter, missing, extra_filters
+        )
+        for item in items:
+            name = ec2_object_name(kind, item)
+            if name in found:
+                found[name].append(item[id_key])
+            self._put(("id", kind, item[id_key]), name)
+
+        for name, ids in found.items():
+            self._put(("name", kind, scope, name), tuple(ids))
+            result[name] = ids
+
+        return result
+
+    def resolve_one(self, kind, name, scope=None):
+        """
+        Get the ids of the objects with the given name.
+        """
+        return self.resolve(kind, [name], scope)[name]
+
+    def name_of(self, kind, object_id):
+        """
+        Get the name of the object with the given id, or None when it does not exist or has no name.
+        """
+        key = ("id", kind, object_id)
+        name = self._get(key)
+        if name is not None:
+            return name
+
+        _, _, _, id_filter, _ = EC2_KINDS[kind]
+        items = list(describe_ec2(self.get_client("ec2"), kind, id_filter, [object_id]))
+        if not items:
+            return None
+
+        name = ec2_object_name(kind, items[0])
+        self._put(key, name)
+        return name
+
+    def invalidate(self, kind, name=None, object_id=None):
+        """
+        Forget the cached ids of a name and the cached name of an id.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if key[1] != kind:
+                    continue
+                if (key[0] == "name" and key[3] == name) or (
+                    key[0] == "id" and key[2] == object_id
+                ):
+                    del self._entries[key]
+
+
+class BatchedIndex(ProviderScoped, abc.ABC):
+    """
+    Base class for the descriptions of objects of a provider that are looked up by name.
+
+    Like the EC2 inventory, the names that handlers register in pre are fetched together, MAX_NAMES names per
+    describe call, and reused for cache_ttl seconds. Subclasses implement _describe.
+    """
+
+    MAX_NAMES = 20
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # name -> time a handler last registered it
+        self._registered = {}
+        # name -> (time fetched, description or None)
+        self._by_name = {}
+
+    def register(self, name):
+        with self._lock:
+            self._registered[name] = time.time()
+
+    def _is_expired(self, name):
+        fetched = self._by_name.get(name)
+        return fetched is None or time.time() - fetched[0] > self.ttl
+
+    def get(self, name):
+        """
+        Get the description of an object or None when it does not exist.
+        """
+        with self._lock:
+            if self._is_expired(name):
+                now = time.time()
+                for registered_name, registered in list(self._registered.items()):
+                    if now - registered > EC2Inventory.REGISTRATION_RETENTION:
+                        del self._registered[registered_name]
+
+                names = {name}
+                if self.ttl > 0:
+                    names |= {x for x in self._registered if self._is_expired(x)}
+                names = sorted(names)
+
+                found = {}
+                for i in range(0, len(names), self.MAX_NAMES):
+                    found.update(self._describe(names[i : i + self.MAX_NAMES]))
+
+                now = time.time()
+                for x in names:
+                    self._by_name[x] = (now, found.get(x))
+            return self._by_name[name][1]
+
+    @abc.abstractmethod
+    def _describe(self, names):
+        """
+        Describe the objects with the given names and return their descriptions by name. Names that do not exist
+        are left out.
+        """
+
+    def invalidate(self, name):
+        with self._lock:
+            self._by_name.pop(name, None)
+
+
+class LoadBalancerIndex(BatchedIndex):
+    """
+    The descriptions of the classic loadbalancers of a provider. A name that does not exist fails the whole
+    describe_load_balancers call, in that case all loadbalancers of the region are listed instead.
+    """
+
+    MAX_NAMES = 20
+
+    def _describe(self, names):
+        paginator = self.get_client("elb").get_paginator("describe_load_balancers")
+        found = {}
+        try:
+            for page in paginator.paginate(LoadBalancerNames=names):
+                for lb in page["LoadBalancerDescriptions"]:
+                    found[lb["LoadBalancerName"]] = lb
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "LoadBalancerNotFound":
+                raise
+            found = {}
+            for page in paginator.paginate():
+                for lb in page["LoadBalancerDescriptions"]:
+                    found[lb["LoadBalancerName"]] = lb
+        return found
+
+
+class ElasticSearchIndex(BatchedIndex):
+    """
+    The status of the ElasticSearch domains of a provider.
+    """
+
+    MAX_NAMES = 5
+
+    def _describe(self, names):
+        result = self.get_client("es").describe_elasticsearch_domains(DomainNames=names)
+        return {domain["DomainName"]: domain for domain in result["DomainStatusList"]}
+
+
+class DatabaseIndex(BatchedIndex):
+    """
+    The RDS instances of a provider. describe_db_instances returns the tags of every instance in its TagList.
+    """
+
+    MAX_NAMES = 100
+
+    def _describe(self, names):
+        paginator = self.get_client("rds").get_paginator("describe_db_instances")
+        # RDS stores the identifiers in lowercase
+        values = sorted({name.lower() for name in names})
+        found = {
+            db["DBInstanceIdentifier"].lower(): db
+            for page in paginator.paginate(
+                Filters=[{"Name": "db-instance-id", "Values": values}]
+            )
+            for db in page["DBInstances"]
+        }
+        return {name: found[name.lower()] for name in names if name.lower() in found}
+
+
+class VpcNetworkIndex(ProviderScoped):
+    """
+    The network interfaces and route tables of the vpcs of a provider, indexed for the route handler: the ENIs by
+    private ip and the routes of every route table by destination. A vpc is described again after cache_ttl
+    seconds, the handlers update the routes they change in place.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # vpc id -> index
+        self._vpcs = {}
+
+    def get(self, vpc_id):
+        """
+        Get the index of a vpc: a dict with the ENIs by private ip in "enis" and the route tables in "route_tables",
+        each a dict with its "RouteTableId" and its "routes" by destination cidr.
+        """
+        with self._lock:
+            network = self._vpcs.get(vpc_id)
+            if network is None or time.time() - network["taken_at"] > self.ttl:
+                network = self._build(vpc_id)
+                self._vpcs[vpc_id] = network
+            return network
+
+    def _build(self, vpc_id):
+        client = self.get_client("ec2")
+        filters = [{"Name": "vpc-id", "Values": [vpc_id]}]
+
+        enis = {}
+        paginator = client.get_paginator("describe_network_interfaces")
+        for page in paginator.paginate(Filters=filters):
+            for eni in page["NetworkInterfaces"]:
+                for address in eni.get("PrivateIpAddresses") or []:
+                    enis.setdefault(address["PrivateIpAddress"], []).append(eni)
+
+        route_tables = []
+        paginator = client.get_paginator("describe_route_tables")
+        for page in paginator.paginate(Filters=filters):
+            for table in page["RouteTables"]:
+                route_tables.append(
+                    {
+                        "RouteTableId": table["RouteTableId"],
+                        "routes": {
+                            route["DestinationCidrBlock"]: route
+                            for route in table["Routes"]
+                            if "DestinationCidrBlock" in route
+                        },
+                    }
+                )
+
+        return {"taken_at": time.time(), "enis": enis, "route_tables": route_tables}
+
+    def set_route(self, route_table, destination, route):
+        """
+        Update a route in the index after it was changed, route None removes it.
+        """
+        with self._lock:
+            if route is None:
+                route_table["routes"].pop(destination, None)
+            else:
+                route_table["routes"][destination] = route
+
+    def invalidate(self, vpc_id):
+        with self._lock:
+            self._vpcs.pop(vpc_id, None)
+
+
+class RouteReconciler(ProviderScoped):
+    """
+    Applies the route changes of the route handlers to a route table in a single pass. The changes that are made
+    to the same route table within BATCH_WINDOW seconds of each other are applied together, against the routes in
+    the VpcNetworkIndex instead of reloading the route table for every route.
+    """
+
+    BATCH_WINDOW = 0.2
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # route table id -> batch
+        self._batches = {}
+
+    def set_route(self, network, vpc_id, route_table, destination, eni_id):
+        """
+        Make the route to destination go to the given ENI, eni_id None removes the route. Returns the action that
+        was taken: created, replaced, deleted or None when the route was already correct.
+        """
+        table_id = route_table["RouteTableId"]
+        with self._lock:
+            batch = self._batches.get(table_id)
+            if batch is None:
+                batch = Batch(self._apply, self.BATCH_WINDOW)
+                self._batches[table_id] = batch
+        return batch.submit((network, vpc_id, route_table, destination, eni_id))
+
+    def _apply(self, changes):
+        client = self.get_client("ec2")
+        results = []
+        for network, vpc_id, route_table, destination, eni_id in changes:
+            table_id = route_table["RouteTableId"]
+            current = route_table["routes"].get(destination)
+            try:
+                if eni_id is None:
+                    if current is None:
+                        results.append(None)
+                        continue
+                    client.delete_route(
+                        RouteTableId=table_id, DestinationCidrBlock=destination
+                    )
+                    network.set_route(route_table, destination, None)
+                    results.append("deleted")
+                    continue
+
+                if current is not None and current.get("NetworkInterfaceId") == eni_id:
+                    results.append(None)
+                    continue
+
+                # replace_route changes the target atomically, the route never disappears
+                operation = (
+                    client.create_route if current is None else client.replace_route
+                )
+                operation(
+                    RouteTableId=table_id,
+                    DestinationCidrBlock=destination,
+                    NetworkInterfaceId=eni_id,
+                )
+                network.set_route(
+                    route_table,
+                    destination,
+                    {
+                        "DestinationCidrBlock": destination,
+                        "NetworkInterfaceId": eni_id,
+                        "State": "active",
+                    },
+                )
+                results.append("created" if current is None else "replaced")
+            except botocore.exceptions.ClientError as e:
+                # The index of the vpc is out of date, it is described again on the next read
+                network.invalidate(vpc_id)
+                results.append(e)
+
+        return results
+
+
+class KeyPairCache(ProviderScoped):
+    """
+    The names and fingerprints of the key pairs in a region. The region has few key pairs that are shared by many
+    virtual machines, so all key pairs are listed at once and reused for cache_ttl seconds.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._taken_at = None
+        # key name -> fingerprint
+        self._keys = {}
+
+    def get(self, name):
+        """
+        Get the fingerprint of a key pair or None when it does not exist.
+        """
+        with self._lock:
+            if self.ttl <= 0:
+                result = self.get_client("ec2").describe_key_pairs(
+                    Filters=[{"Name": "key-name", "Values": [name]}]
+                )
+                return next((x["KeyFingerprint"] for x in result["KeyPairs"]), None)
+
+            if self._taken_at is None or time.time() - self._taken_at > self.ttl:
+                result = self.get_client("ec2").describe_key_pairs()
+                self._keys = {
+                    x["KeyName"]: x["KeyFingerprint"] for x in result["KeyPairs"]
+                }
+                self._taken_at = time.time()
+            return self._keys.get(name)
+
+    def add(self, name, fingerprint):
+        with self._lock:
+            self._keys[name] = fingerprint
+
+
+class ImageCache(ProviderScoped):
+    """
+    The metadata of the AMIs used by the virtual machines of a provider. Images hardly ever change, so an image is
+    only described again after IMAGE_TTL seconds.
+    """
+
+    IMAGE_TTL = 3600
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # image id -> (time fetched, describe result)
+        self._images = {}
+
+    def get(self, image_id):
+        """
+        Get the describe result of an image or None when it does not exist. The handlers get their own copy, so
+        they can change it.
+        """
+        with self._lock:
+            fetched = self._images.get(image_id)
+            if fetched is None or time.time() - fetched[0] > self.IMAGE_TTL:
+                images = self.get_client("ec2").describe_images(ImageIds=[image_id])[
+                    "Images"
+                ]
+                fetched = (time.time(), images[0] if images else None)
+                self._images[image_id] = fetched
+            return copy.deepcopy(fetched[1])
+
+
+# The default settings of the waiters, per operation. They can be overridden with aws::Provider.waiters
+WAIT_DEFAULTS = {
+    "instance_terminated": {
+        "timeout": 600,
+        "max_attempts": 120,
+        "initial_delay": 2,
+        "max_delay": 15,
+    },
+    "root_volume": {
+        "timeout": 60,
+        "max_attempts": 60,
+        "initial_delay": 0.5,
+        "max_delay": 5,
+    },
+    "internet_gateway": {
+        "timeout": 120,
+        "max_attempts": 60,
+        "initial_delay": 0.5,
+        "max_delay": 5,
+    },
+    "instance_running": {
+        "timeout": 300,
+        "max_attempts": 150,
+        "initial_delay": 2,
+        "max_delay": 15,
+    },
+    "volume_available": {
+        "timeout": 300,
+        "max_attempts": 150,
+        "initial_delay": 2,
+        "max_delay": 15,
+    },
+    "create_subnet": {
+        "timeout": 60,
+        "max_attempts": 5,
+        "initial_delay": 2,
+        "max_delay": 10,
+    },
+    "create_tags": {
+        "timeout": 30,
+        "max_attempts": 5,
+        "initial_delay": 1,
+        "max_delay": 8,
+    },
+    "security_group": {
+        "timeout": 60,
+        "max_attempts": 30,
+        "initial_delay": 1,
+        "max_delay": 5,
+    },
+}
+
+
+class WaitTimeout(Exception):
+    """
+    A waiter gave up before its condition was met
+    """
+
+
+class WaitStatistics:
+    """
+    Keeps how long the waits of each operation took, to tune the waiter settings.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, operation, duration, attempts, success):
+        with self._lock:
+            stats = self._stats.setdefault(
+                operation,
+                {"count": 0, "timeouts": 0, "attempts": 0, "total": 0.0, "max": 0.0},
+            )
+            stats["count"] += 1
+            stats["attempts"] += attempts
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+            if not success:
+                stats["timeouts"] += 1
+
+    def get(self):
+        with self._lock:
+            return {operation: dict(stats) for operation, stats in self._stats.items()}
+
+
+WAIT_STATISTICS = WaitStatistics()
+
+
+class Waiter:
+    """
+    Wait for a condition with exponential backoff and jitter.
+
+    The delay between two attempts starts at initial_delay and doubles after every attempt up to max_delay. A
+    random jitter of up to half the delay spreads the calls of handlers that started waiting at the same time. The
+    waiter gives up after max_attempts attempts or when timeout seconds have passed.
+    """
+
+    def __init__(self, operation, timeout, max_attempts, initial_delay, max_delay):
+        self.operation = operation
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def for_operation(cls, resource, operation):
+        """
+        Create the waiter for an operation, with the settings of the provider of the given resource.
+        """
+        settings = dict(WAIT_DEFAULTS[operation])
+        settings.update(resource.provider["waiters"].get(operation, {}))
+        return cls(operation, **settings)
+
+    def until(self, condition, ctx=None):
+        """
+        Call condition until it returns a true value and return that value.
+
+        :raises WaitTimeout: The condition was not met within the timeout or the maximum number of attempts.
+        """
+        start = time.monotonic()
+        delay = self.initial_delay
+        attempts = 0
+        while True:
+            attempts += 1
+            result = condition()
+            elapsed = time.monotonic() - start
+            if result:
+                self._record(ctx, elapsed, attempts, True)
+                return result
+
+            if attempts >= self.max_attempts or elapsed >= self.timeout:
+                self._record(ctx, elapsed, attempts, False)
+                raise WaitTimeout(
+                    f"Timeout: {self.operation} did not complete after {attempts} attempts ({elapsed:.0f}sec)"
+                )
+
+            sleep = min(delay, self.max_delay)
+            sleep = sleep / 2 + random.uniform(0, sleep / 2)
+            time.sleep(min(sleep, self.timeout - elapsed))
+            delay *= 2
+
+    def call(self, function, retry_on=(botocore.exceptions.ClientError,), ctx=None):
+        """
+        Call function until it no longer raises one of the retry_on exceptions and return its result. When the
+        waiter gives up, the last exception is raised again.
+        """
+        errors = []
+
+        def attempt():
+            try:
+                return (function(),)
+            except retry_on as e:
+                if ctx is not None:
+                    ctx.debug(
+                        "%(operation)s failed, retrying",
+                        operation=self.operation,
+                        exc_info=True,
+                    )
+                errors.append(e)
+                return None
+
+        try:
+            return self.until(attempt, ctx)[0]
+        except WaitTimeout:
+            raise errors[-1]
+
+    def _record(self, ctx, duration, attempts, success):
+        WAIT_STATISTICS.record(self.operation, duration, attempts, success)
+        if ctx is not None:
+            ctx.debug(
+                "Waited %(duration).2fsec for %(operation)s (%(attempts)d attempts)",
+                duration=duration,
+                operation=self.operation,
+                attempts=attempts,
+            )
+
+
+class Batch:
+    """
+    Collects the requests that handlers make at about the same time, so they can be sent in a single API call.
+
+    The first handler that submits an item to an empty batch waits window seconds for the other handlers to add
+    theirs, then calls flush with all items. flush returns one result per item, in the same order. A result that
+    is an exception is raised in the handler that submitted the item.
+    """
+
+    def __init__(self, flush, window):
+        self._flush = flush
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def submit(self, item):
+        entry = {"item": item, "done": threading.Event(), "result": None}
+        with self._lock:
+            self._pending.append(entry)
+            leader = len(self._pending) == 1
+
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                entries, self._pending = self._pending, []
+            try:
+                results = self._flush([e["item"] for e in entries])
+            except Exception as e:
+                results = [e] * len(entries)
+            for e, result in zip(entries, results):
+                e["result"] = result
+                e["done"].set()
+        else:
+            entry["done"].wait()
+
+        if isinstance(entry["result"], Exception):
+            raise entry["result"]
+        return entry["result"]
+
+
+class InstanceTerminator(ProviderScoped):
+    """
+    Terminates the instances of a provider in batches. Instances that are terminated within BATCH_WINDOW seconds
+    of each other share one terminate_instances call.
+    """
+
+    BATCH_WINDOW = 0.5
+
+    def __init__(self):
+        super().__init__()
+        self._batch = Batch(self._terminate, self.BATCH_WINDOW)
+
+    def terminate(self, instance_id):
+        """
+        Request the termination of an instance and return its new state.
+        """
+        return self._batch.submit(instance_id)
+
+    def _terminate(self, instance_ids):
+        client = self.get_client("ec2")
+        states = {}
+        for i in range(0, len(instance_ids), MAX_FILTER_VALUES):
+            chunk = instance_ids[i : i + MAX_FILTER_VALUES]
+            try:
+                result = client.terminate_instances(InstanceIds=chunk)
+            except botocore.exceptions.ClientError as e:
+                if len(chunk) == 1:
+                    states[chunk[0]] = e
+                    continue
+                # One invalid instance fails the entire call, give every instance its own result
+                for instance_id in chunk:
+                    try:
+                        result = client.terminate_instances(InstanceIds=[instance_id])
+                        states[instance_id] = result["TerminatingInstances"][0][
+                            "CurrentState"
+                        ]["Name"]
+                    except botocore.exceptions.ClientError as e:
+                        states[instance_id] = e
+                continue
+
+            for instance in result["TerminatingInstances"]:
+                states[instance["InstanceId"]] = instance["CurrentState"]["Name"]
+
+        return [states.get(instance_id) for instance_id in instance_ids]
+
+
+class InstanceLauncher(ProviderScoped):
+    """
+    Launches the instances of a provider in groups. Instances with the same launch parameters that are created
+    within BATCH_WINDOW seconds of each other are launched with a single run_instances call and get their own
+    Name tag afterwards.
+    """
+
+    BATCH_WINDOW = 0.5
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # launch parameters -> batch
+        self._batches = {}
+
+    def launch(self, args, name):
+        """
+        Launch an instance with the given run_instances arguments and Name tag, and return its describe result.
+        """
+        key = json.dumps(args, sort_keys=True)
+
+        def flush(names):
+            # Instances that arrive from now on start a new batch, so no batch outlives its launch
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+            return self._launch(args, names)
+
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = Batch(flush, self.BATCH_WINDOW)
+                self._batches[key] = batch
+        return batch.submit(name)
+
+    def _launch(self, args, names):
+        client = self.get_client("ec2")
+        name_tag = {"Key": "Name", "Value": names[0]}
+        if len(names) == 1:
+            # A single instance gets its name when it is launched
+            args = dict(args)
+            specifications = args.get("TagSpecifications", [])
+            tags = specifications[0]["Tags"] if specifications else []
+            args["TagSpecifications"] = [
+                {"ResourceType": "instance", "Tags": tags + [name_tag]}
+            ]
+
+        instances = client.run_instances(MinCount=1, MaxCount=len(names), **args)[
+            "Instances"
+        ]
+        if len(names) == 1:
+            return instances
+
+        results = []
+        waiter = Waiter("create_tags", **WAIT_DEFAULTS["create_tags"])
+        for i, name in enumerate(names):
+            if i >= len(instances):
+                results.append(
+                    Exception(
+                        f"Launched {len(instances)} of {len(names)} instances, none left for {name}"
+                    )
+                )
+                continue
+
+            instance_id = instances[i]["InstanceId"]
+            try:
+                waiter.call(
+                    lambda: client.create_tags(
+                        Resources=[instance_id],
+                        Tags=[{"Key": "Name", "Value": name}],
+                    )
+                )
+            except botocore.exceptions.ClientError as e:
+                # An instance without a name is lost to the handlers
+                client.terminate_instances(InstanceIds=[instance_id])
+                results.append(e)
+                continue
+            results.append(instances[i])
+        return results
+
+
+def ec2_filter_values(kind, filter_name, item):
+    """
+    Get the values of the given describe filter that match an EC2 object.
+    """
+    _, _, id_key, id_filter, name_filter = EC2_KINDS[kind]
+    if filter_name == id_filter:
+        return {item[id_key]}
+    if filter_name == name_filter:
+        return {ec2_object_name(kind, item)}
+    if filter_name == "attachment.instance-id":
+        return {
+            attachment["InstanceId"]
+            for attachment in item.get("Attachments") or []
+            if "InstanceId" in attachment
+        }
+    raise ValueError(f"Unsupported filter {filter_name} for {kind}")
+
+
+class StatePoller(ProviderScoped):
+    """
+    Polls the state of the EC2 objects that handlers wait for, in a background thread per provider.
+
+    Handlers register the objects they wait for with a describe filter and a condition on the matching objects.
+    Every POLL_INTERVAL seconds the poller sends one describe call per kind and filter for all registered values
+    and wakes the handlers whose condition is met. The thread stops when nobody is waiting anymore.
+    """
+
+    POLL_INTERVAL = 2
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        # (kind, filter name) -> value -> waits
+        self._waits = {}
+        self._thread = None
+
+    def wait(self, waiter, kind, filter_name, value, condition, ctx=None):
+        """
+        Wait until condition returns true for the list of objects of the given kind that match filter_name=value
+        and return that list. The timeout and the maximum number of polls are taken from the waiter.
+
+        :raises WaitTimeout: The condition was not met in time.
+        :raises Exception: The exception raised by the condition.
+        """
+        return self.wait_all([(waiter, kind, filter_name, value, condition)], ctx)[0]
+
+    def wait_all(self, waits, ctx=None):
+        """
+        Wait for several objects at once. Every wait is a tuple (waiter, kind, filter_name, value, condition) with
+        the arguments of wait. Returns the lists of objects in the order of the waits.
+
+        :raises WaitTimeout: A condition was not met in time.
+        :raises Exception: The exception raised by a condition.
+        """
+        entries = []
+        start = time.monotonic()
+        with self._lock:
+            for waiter, kind, filter_name, value, condition in waits:
+                entry = {
+                    "waiter": waiter,
+                    "key": (kind, filter_name),
+                    "value": value,
+                    "condition": condition,
+                    "done": threading.Event(),
+                    "items": None,
+                    "polls": 0,
+                    "max_polls": waiter.max_attempts,
+                    "error": None,
+                }
+                self._waits.setdefault(entry["key"], {}).setdefault(value, []).append(
+                    entry
+                )
+                entries.append(entry)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="aws-state-poller", daemon=True
+                )
+                self._thread.start()
+
+        for entry in entries:
+            remaining = entry["waiter"].timeout - (time.monotonic() - start)
+            entry["done"].wait(max(remaining, 0))
+
+        with self._lock:
+            for entry in entries:
+                waits = self._waits.get(entry["key"], {})
+                value = entry["value"]
+                if entry in waits.get(value, []):
+                    waits[value].remove(entry)
+                    if not waits[value]:
+                        del waits[value]
+                    if not waits:
+                        del self._waits[entry["key"]]
+
+        elapsed = time.monotonic() - start
+        for entry in entries:
+            entry["waiter"]._record(
+                ctx, elapsed, entry["polls"], entry["items"] is not None
+            )
+        for entry in entries:
+            if entry["error"] is not None:
+                raise entry["error"]
+        for entry in entries:
+            if entry["items"] is None:
+                raise WaitTimeout(
+                    f"Timeout: {entry['waiter'].operation} did not complete after {entry['polls']} polls"
+                    f" ({elapsed:.0f}sec)"
+                )
+        return [entry["items"] for entry in entries]
+
+    def _run(self):
+        try:
+            while True:
+                time.sleep(self.POLL_INTERVAL)
+                with self._lock:
+                    todo = {
+                        key: list(values)
+                        for key, values in self._waits.items()
+                        if values
+                    }
+                    if not todo:
+                        # Decide and clear under the same lock, so a new wait starts a new thread
+                        self._thread = None
+                        return
+
+                for (kind, filter_name), values in sorted(todo.items()):
+                    self._poll(kind, filter_name, sorted(values))
+        except Exception as e:
+            LOGGER.exception("The state poller failed")
+            with self._lock:
+                for waits in self._waits.values():
+                    for entries in waits.values():
+                        for entry in entries:
+                            entry["error"] = e
+                            entry["done"].set()
+                self._waits.clear()
+                self._thread = None
+
+    def _poll(self, kind, filter_name, values):
+        try:
+            items = list(
+                describe_ec2(self.get_client("ec2"), kind, filter_name, values)
+            )
+        except Exception:
+            LOGGER.exception("Failed to poll the state of %s", kind)
+            return
+
+        found = {value: [] for value in values}
+        for item in items:
+            for value in ec2_filter_values(kind, filter_name, item):
+                if value in found:
+                    found[value].append(item)
+
+        with self._lock:
+            waits = self._waits.get((kind, filter_name), {})
+            for value, matches in found.items():
+                remaining = []
+                for entry in waits.get(value, []):
+                    entry["polls"] += 1
+                    try:
+                        done = entry["condition"](matches)
+                    except Exception as e:
+                        entry["error"] = e
+                        entry["done"].set()
+                        continue
+                    if done:
+                        entry["items"] = matches
+                        entry["done"].set()
+                    elif entry["polls"] >= entry["max_polls"]:
+                        entry["done"].set()
+                    else:
+                        remaining.append(entry)
+                if remaining:
+                    waits[value] = remaining
+                else:
+                    waits.pop(value, None)
+
+
+@plugin
+def get_api_id(provider: "aws::Provider", api_name: "string") -> "string":
+    access_key, secret_key = get_credentials(provider.access_key, provider.secret_key)
+    client = CLIENT_POOL.get_client(
+        provider.region, access_key, secret_key, "apigateway"
     )
-    client = session.client("apigateway")
 
     apis = client.get_rest_apis()
 
@@ -139,6 +1634,9 @@ class AWSResource(PurgeableResource, ManagedResource):
             "availability_zone": resource.provider.availability_zone,
             "access_key": resource.provider.access_key,
             "secret_key": resource.provider.secret_key,
+            "cache_ttl": resource.provider.cache_ttl,
+            "waiters": resource.provider.waiters,
+            "log_api_responses": resource.provider.log_api_responses,
         }
 
 
@@ -183,6 +1681,7 @@ class VirtualMachine(AWSResource):
         "ignore_wrong_image",
         "root_volume_size",
         "root_volume_type",
+        "wait_for_termination",
     )
 
     @staticmethod
@@ -372,45 +1871,91 @@ class RDS(AWSResource):
 
 
 class AWSHandler(CRUDHandler):
+    # The kind of EC2 object this handler reads from the inventory by name, if any
+    inventory_kind = None
+
     def __init__(self, agent, io=None) -> None:
         CRUDHandler.__init__(self, agent, io=io)
 
-        self._session = None
+        self._credentials = None
         self._ec2 = None
         self._elb = None
+        self._inventory = None
+        self._resolver = None
+        self._poller = None
 
     def pre(self, ctx: HandlerContext, resource: AWSResource) -> None:
         CRUDHandler.pre(self, ctx, resource)
 
-        access_key = resource.provider["access_key"]
-        if access_key is None:
-            access_key = os.environ.get("AWS_ACCESS_KEY")
-        if access_key is None:
-            raise Exception(
-                "AWS_ACCESS_KEY has to be provided as an environment variable."
-            )
-
-        secret_key = resource.provider["secret_key"]
-        if secret_key is None:
-            secret_key = os.environ.get("AWS_SECRET_KEY")
-        if secret_key is None:
-            raise Exception(
-                "AWS_SECRET_KEY has to be provided as an environment variable."
-            )
-
-        self._session = boto3.Session(
-            region_name=resource.provider["region"],
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
+        access_key, secret_key = get_credentials(
+            resource.provider["access_key"], resource.provider["secret_key"]
+        )
+        self._credentials = (resource.provider["region"], access_key, secret_key)
+        self._ec2 = CLIENT_POOL.get_resource(*self._credentials, "ec2")
+        self._elb = self._get_aws_client("elb")
+        self._inventory = EC2Inventory.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
         )
-        self._ec2 = self._session.resource("ec2")
-        self._elb = self._session.client("elb")
+        self._resolver = NameResolver.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        )
+        self._poller = StatePoller.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        )
+        if self.inventory_kind is not None:
+            self._inventory.register(self.inventory_kind, resource.name)
 
     def post(self, ctx: HandlerContext, resource: AWSResource) -> None:
         CRUDHandler.post(self, ctx, resource)
 
         self._ec2 = None
         self._elb = None
+        LOGGER.debug("AWS client pool stats: %s", CLIENT_POOL.stats())
+
+    def _get_aws_client(self, service):
+        """
+        Get a pooled client for the given service with the credentials of the current resource.
+        """
+        return CLIENT_POOL.get_client(*self._credentials, service)
+
+    def _invalidate(self, kind, name=None, object_id=None):
+        """
+        Mark an EC2 object that this handler changed as stale in the shared caches.
+        """
+        self._inventory.invalidate(kind, name=name, object_id=object_id)
+        self._resolver.invalidate(kind, name=name, object_id=object_id)
+
+    def _ec2_object(self, factory, object_id, data):
+        """
+        Build a boto3 ec2 resource object from a describe result, so it does not have to be loaded again.
+        """
+        obj = getattr(self._ec2, factory)(object_id)
+        obj.meta.data = data
+        return obj
+
+    def _name_tag_specification(self, resource_type, name):
+        return [
+            {"ResourceType": resource_type, "Tags": [{"Key": "Name", "Value": name}]}
+        ]
+
+    def _ensure_name_tag(self, ctx, resource, obj, description):
+        """
+        Objects are tagged when they are created. Only when the name tag is missing, add it with retries: tagging
+        right after creation tends to hit eventual consistency problems returning an error that the object does
+        not exist. When that fails, the object is deleted again.
+        """
+        if self.get_name_from_tag(obj.tags) == resource.name:
+            return
+
+        ctx.debug("Name tag missing on %(id)s, adding it", id=obj.id)
+        try:
+            Waiter.for_operation(resource, "create_tags").call(
+                lambda: obj.create_tags(Tags=[{"Key": "Name", "Value": resource.name}]),
+                ctx=ctx,
+            )
+        except botocore.exceptions.ClientError:
+            obj.delete()
+            raise Exception(f"Failed to associate tag with {description} {obj.id}")
 
     def tags_amazon_to_internal(self, tags):
         return {i["Key"]: i["Value"] for i in tags}
@@ -433,44 +1978,63 @@ class ELBHandler(AWSHandler):
     This class manages ELB instances on amazon ec2
     """
 
+    def pre(self, ctx: HandlerContext, resource: AWSResource) -> None:
+        AWSHandler.pre(self, ctx, resource)
+        self._loadbalancers = LoadBalancerIndex.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        )
+        self._loadbalancers.register(resource.name)
+
     def _get_name(self, vm):
-        tags = vm.tags if vm.tags is not None else []
-        for tag in tags:
-            if tag["Key"] == "Name":
-                return tag["Value"]
+        name = self.get_name_from_tag(vm.get("Tags"))
+        if name is not None:
+            return name
 
-        return vm.instance_id
+        return vm["InstanceId"]
 
-    def _get_security_group(self, security_groups, name):
-        for sg in security_groups.values():
-            if sg.group_name == name:
-                return sg.id
+    def _get_security_group(self, name):
+        sg_ids = self._resolver.resolve_one("security_groups", name)
+        if len(sg_ids) == 0:
+            return None
 
-        return None
+        return sg_ids[0]
 
-    def read_resource(self, ctx, resource: ELB):
-        vms = {
-            self._get_name(x): x
-            for x in self._ec2.instances.all()
-            if x.state["Name"] != "terminated"
-        }
-        vm_ids = {x.id: x for x in vms.values()}
-        security_groups = {sg.id: sg for sg in self._ec2.security_groups.all()}
+    def _get_instance_ids(self, ctx, resource, names):
+        """
+        Resolve the names of instances to their ids, the instances that do not exist are skipped.
+        """
+        resolved = self._resolver.resolve("instances", names)
+        instance_ids = []
+        for name in names:
+            if len(resolved[name]) == 0:
+                ctx.warning(
+                    "Instance %(instance)s not added to aws::ELB %(elb)s, because it does not exist.",
+                    instance=name,
+                    elb=resource.name,
+                )
+            else:
+                instance_ids.append(resolved[name][0])
 
-        ctx.set("vms", vms)
-        ctx.set("security_groups", security_groups)
+        return instance_ids
 
-        try:
-            loadbalancer = self._elb.describe_load_balancers(
-                LoadBalancerNames=[resource.name]
-            )["LoadBalancerDescriptions"][0]
-        except botocore.exceptions.ClientError:
+    def read_resource(self, ctx, resource: ELB):
+        loadbalancer = self._loadbalancers.get(resource.name)
+        if loadbalancer is None:
             raise ResourcePurged()
 
         resource.purged = False
-        resource.instances = sorted(
-            self._get_name(vm_ids[x["InstanceId"]]) for x in loadbalancer["Instances"]
+
+        # Only look up the instances that are registered with this loadbalancer
+        instances = self._inventory.get_many(
+            "instances", [x["InstanceId"] for x in loadbalancer["Instances"]]
         )
+        members = {
+            self._get_name(vm): vm["InstanceId"]
+            for vm in instances.values()
+            if vm["State"]["Name"] != "terminated"
+        }
+        ctx.set("members", members)
+        resource.instances = sorted(members.keys())
 
         if len(loadbalancer["ListenerDescriptions"]) > 0:
             if len(loadbalancer["ListenerDescriptions"]) > 1:
@@ -489,17 +2053,16 @@ class ELBHandler(AWSHandler):
                 )
 
             sg = loadbalancer["SecurityGroups"][0]
+            security_groups = self._inventory.get_many("security_groups", [sg])
             if sg in security_groups:
-                resource.security_group = security_groups[sg].group_name
+                resource.security_group = security_groups[sg]["GroupName"]
             else:
                 raise Exception(
                     "Invalid amazon response, a security group is used by the loadbalancer but not defined?!?"
                 )
 
     def create_resource(self, ctx: HandlerContext, resource: ELB) -> None:
-        sg_id = self._get_security_group(
-            ctx.get("security_groups"), resource.security_group
-        )
+        sg_id = self._get_security_group(resource.security_group)
         ctx.debug("Creating loadbalancer with security group %(sg)s", sg=sg_id)
         if sg_id is None:
             raise Exception(
@@ -523,39 +2086,35 @@ class ELBHandler(AWSHandler):
         )
 
         # register instances
-        vms = ctx.get("vms")
-        instance_list = []
-        for inst in resource.instances:
-            if inst not in vms:
-                ctx.warning(
-                    "Instance %(instance)s not added to aws::ELB %(elb)s, because it does not exist.",
-                    instance=inst,
-                    elb=resource.name,
-                )
-            else:
-                instance_list.append({"InstanceId": vms[inst].id})
+        instance_list = [
+            {"InstanceId": x}
+            for x in self._get_instance_ids(ctx, resource, resource.instances)
+        ]
 
         if len(instance_list) > 0:
             self._elb.register_instances_with_load_balancer(
                 LoadBalancerName=resource.name, Instances=instance_list
             )
 
+        self._loadbalancers.invalidate(resource.name)
         ctx.set_created()
 
     def delete_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
         self._elb.delete_load_balancer(LoadBalancerName=resource.name)
+        self._loadbalancers.invalidate(resource.name)
         ctx.set_purged()
 
     def update_resource(
         self, ctx: HandlerContext, changes: dict, resource: VirtualMachine
     ) -> None:
-        vms = ctx.get("vms")
-
         if "instances" in changes:
             new_instances = set(changes["instances"]["desired"])
             old_instances = set(changes["instances"]["current"])
-            add = [vms[vm].id for vm in new_instances - old_instances if vm in vms]
-            remove = [vms[vm].id for vm in old_instances - new_instances if vm in vms]
+            members = ctx.get("members")
+            add = self._get_instance_ids(
+                ctx, resource, sorted(new_instances - old_instances)
+            )
+            remove = [members[vm] for vm in old_instances - new_instances]
 
             if len(add) > 0:
                 self._elb.register_instances_with_load_balancer(
@@ -571,9 +2130,7 @@ class ELBHandler(AWSHandler):
 
         if "security_group" in changes:
             # set the security group
-            sg_id = self._get_security_group(
-                ctx.get("security_groups"), resource.security_group
-            )
+            sg_id = self._get_security_group(resource.security_group)
             ctx.debug("Change loadbalancer with security group %(sg)s", sg=sg_id)
             if sg_id is None:
                 raise Exception(
@@ -601,28 +2158,27 @@ class ELBHandler(AWSHandler):
                 LoadBalancerName="string", LoadBalancerPorts=[resource.listen_port]
             )
 
+        self._loadbalancers.invalidate(resource.name)
+
     def facts(self, ctx, resource):
-        try:
-            loadbalancer = self._elb.describe_load_balancers(
-                LoadBalancerNames=[resource.name]
-            )["LoadBalancerDescriptions"][0]
-            return {"dns_name": loadbalancer["DNSName"]}
-        except botocore.exceptions.ClientError:
+        loadbalancer = self._loadbalancers.get(resource.name)
+        if loadbalancer is None:
             return {}
+        return {"dns_name": loadbalancer["DNSName"]}
 
 
 @provider("aws::VirtualMachine", name="ec2")
 class VirtualMachineHandler(AWSHandler):
-    def _get_subnet(self, subnet_id):
-        subnets = list(self._ec2.subnets.filter(SubnetIds=[subnet_id]))
-        if len(subnets) == 0:
-            return None
-        return subnets[0]
+    inventory_kind = "instances"
 
-    def _get_subnet_by_name(self, ctx, name):
-        subnets = list(
-            self._ec2.subnets.filter(Filters=[{"Name": "tag:Name", "Values": [name]}])
+    def pre(self, ctx: HandlerContext, resource: AWSResource) -> None:
+        AWSHandler.pre(self, ctx, resource)
+        self._key_pairs = KeyPairCache.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
         )
+
+    def _get_subnet_by_name(self, ctx, name):
+        subnets = self._resolver.resolve_one("subnets", name)
         if len(subnets) == 0:
             ctx.info("No subnet found with tag Name %(name)s", name=name)
             raise SkipResource()
@@ -635,32 +2191,32 @@ class VirtualMachineHandler(AWSHandler):
             )
             raise SkipResource()
 
-        subnet = subnets[0]
+        subnet = self._inventory.get_by_id("subnets", subnets[0])
+        if subnet is None:
+            ctx.info("No subnet found with tag Name %(name)s", name=name)
+            raise SkipResource()
+
         return subnet
 
     def read_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
-        key_pairs = list(
-            self._ec2.key_pairs.filter(
-                Filters=[{"Name": "key-name", "Values": [resource.key_name]}]
-            )
-        )
-        if len(key_pairs) == 0:
+        fingerprint = self._key_pairs.get(resource.key_name)
+        if fingerprint is None:
             ctx.set("key", None)
-        elif len(key_pairs) > 1:
-            ctx.info(
-                "Multiple keys with name %(name)s already deployed",
-                name=resource.key_name,
-            )
-            raise SkipResource()
         else:
             ctx.set("key", True)
+            expected = key_fingerprint(resource.key_value)
+            if expected is not None and fingerprint.rstrip("=") != expected:
+                ctx.warning(
+                    "The key pair %(name)s in EC2 does not match the public key in the model",
+                    name=resource.key_name,
+                    fingerprint=fingerprint,
+                    expected=expected,
+                )
 
         instance = [
             x
-            for x in self._ec2.instances.filter(
-                Filters=[{"Name": "tag:Name", "Values": [resource.name]}]
-            )
-            if x.state["Name"] != "terminated"
+            for x in self._inventory.get("instances", resource.name)
+            if x["State"]["Name"] != "terminated"
         ]
         if len(instance) == 0:
             raise ResourcePurged()
@@ -673,7 +2229,15 @@ class VirtualMachineHandler(AWSHandler):
             )
             raise SkipResource()
 
-        instance = instance[0]
+        instance = self._ec2_object("Instance", instance[0]["InstanceId"], instance[0])
+        if instance.state["Name"] == "shutting-down":
+            # A previous deploy terminated the instance, only the delete can still finish it
+            if not resource.purged:
+                raise SkipResource(f"Instance {instance.id} is still shutting down")
+            ctx.set("instance", instance)
+            resource.purged = False
+            return
+
         ctx.set("instance", instance)
         resource.purged = False
         resource.flavor = instance.instance_type
@@ -690,21 +2254,40 @@ class VirtualMachineHandler(AWSHandler):
             When a VM is created it doesn't have a root volume for a certain time window.
             This method waits until the root volume exists.
             """
-            tries = 60
-            while tries > 0:
-                root_volumes = [
-                    volume
-                    for volume in instance.volumes.all()
-                    if volume.attachments[0]["Device"] == root
-                ]
-                if len(root_volumes) == 0:
-                    time.sleep(1)
-                    tries -= 1
-                else:
-                    return root_volumes[0]
-            raise Exception(f"No root volume found for VM {instance.id}")
+            try:
+                volumes = self._poller.wait(
+                    Waiter.for_operation(resource, "root_volume"),
+                    "volumes",
+                    "attachment.instance-id",
+                    instance.id,
+                    lambda volumes: any(
+                        volume["Attachments"][0]["Device"] == root for volume in volumes
+                    ),
+                    ctx,
+                )
+            except WaitTimeout:
+                raise Exception(f"No root volume found for VM {instance.id}")
+
+            volume = next(
+                volume
+                for volume in volumes
+                if volume["Attachments"][0]["Device"] == root
+            )
+            return self._ec2_object("Volume", volume["VolumeId"], volume)
+
+        volumes = [
+            self._ec2_object("Volume", volume["VolumeId"], volume)
+            for volume in self._inventory.get_attached("volumes", instance.id)
+        ]
+        root_volumes = [
+            volume for volume in volumes if volume.attachments[0]["Device"] == root
+        ]
+        if len(root_volumes) > 0:
+            root_volume = root_volumes[0]
+        else:
+            root_volume = get_root_volume()
+            volumes = list(instance.volumes.all())
 
-        root_volume = get_root_volume()
         resource.root_volume_size = root_volume.size
         ctx.set("root_volume", root_volume)
 
@@ -712,7 +2295,7 @@ class VirtualMachineHandler(AWSHandler):
             x
             for x in [
                 self.get_name_from_tag(volume.tags)
-                for volume in instance.volumes.all()
+                for volume in volumes
                 if volume.attachments[0]["Device"] != root
             ]
             if x is not None
@@ -720,13 +2303,9 @@ class VirtualMachineHandler(AWSHandler):
         resource.subnet_id = instance.subnet_id
 
         if instance.subnet_id is not None:
-            subnet = self._get_subnet(instance.subnet_id)
-            if subnet is not None and subnet.tags is not None:
-                name_tag = [x for x in subnet.tags if x["Key"] == "Name"]
-                if len(name_tag) > 0:
-                    resource.subnet = name_tag[0]["Value"]
-                else:
-                    resource.subnet = None
+            subnet = self._inventory.get_by_id("subnets", instance.subnet_id)
+            if subnet is not None:
+                resource.subnet = self.get_name_from_tag(subnet.get("Tags"))
             else:
                 resource.subnet = None
 
@@ -743,83 +2322,93 @@ class VirtualMachineHandler(AWSHandler):
         resource.source_dest_check = result["SourceDestCheck"]["Value"]
 
     def _ensure_key(self, ctx: HandlerContext, key_name, key_value):
-        self._ec2.import_key_pair(
-            KeyName=key_name, PublicKeyMaterial=key_value.encode()
-        )
+        try:
+            result = self._get_aws_client("ec2").import_key_pair(
+                KeyName=key_name, PublicKeyMaterial=key_value.encode()
+            )
+        except botocore.exceptions.ClientError as e:
+            # Another virtual machine with the same key imported it first
+            if e.response["Error"]["Code"] != "InvalidKeyPair.Duplicate":
+                raise
+            return
+        self._key_pairs.add(key_name, result["KeyFingerprint"])
 
     def create_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
         if not ctx.get("key"):
             self._ensure_key(ctx, resource.key_name, resource.key_value)
 
-        itags = resource.tags
-        itags["Name"] = resource.name
-        tags = self.tags_internal_to_amazon(itags)
-
         if resource.subnet is not None:
             subnet = self._get_subnet_by_name(ctx, resource.subnet)
-            subnet_id = subnet.id
-            vpc_id = subnet.vpc.id
+            subnet_id = subnet["SubnetId"]
+            vpc_id = subnet["VpcId"]
         else:
             subnet_id = resource.subnet_id
-            subnets = list(self._ec2.subnets.filter(SubnetIds=[subnet_id]))
-            if len(subnets) == 0:
+            subnet = self._inventory.get_by_id("subnets", subnet_id)
+            if subnet is None:
                 raise SkipResource("Subnet %s does not exist" % subnet_id)
-            vpc_id = subnets[0].vpc.id
+            vpc_id = subnet["VpcId"]
 
         callargs = {}
         if len(resource.security_groups) > 0:
-            sgs = list(
-                self._ec2.security_groups.filter(
-                    Filters=[
-                        {"Name": "group-name", "Values": resource.security_groups},
-                        {"Name": "vpc-id", "Values": [vpc_id]},
-                    ]
-                )
+            sgs = self._resolver.resolve(
+                "security_groups", resource.security_groups, scope=vpc_id
             )
-            if len(sgs) != len(resource.security_groups):
+            sg_ids = [sg_id for ids in sgs.values() for sg_id in ids]
+            if len(sg_ids) != len(resource.security_groups):
                 ctx.warning(
                     "Unable to find the correct number of security groups. Found: %(groups)s",
-                    groups=[x.group_name for x in sgs],
+                    groups=[name for name, ids in sgs.items() if len(ids) > 0],
                 )
-            callargs["SecurityGroupIds"] = [x.id for x in sgs]
+            callargs["SecurityGroupIds"] = sg_ids
+
+        # The Name tag is set by the launcher
+        common_tags = {k: v for k, v in resource.tags.items() if k != "Name"}
+        if common_tags:
+            callargs["TagSpecifications"] = [
+                {
+                    "ResourceType": "instance",
+                    "Tags": self.tags_internal_to_amazon(common_tags),
+                }
+            ]
 
-        image = list(self._ec2.images.filter(ImageIds=[resource.image]))[0]
-        block_device_mapping = image.meta.data["BlockDeviceMappings"]
+        image = ImageCache.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        ).get(resource.image)
+        if image is None:
+            raise SkipResource(f"Image {resource.image} does not exist")
+        block_device_mapping = image["BlockDeviceMappings"]
         block_device_mapping[0]["Ebs"]["VolumeSize"] = resource.root_volume_size
         block_device_mapping[0]["Ebs"]["VolumeType"] = resource.root_volume_type
 
         ctx.info("args %(args)s", args=callargs)
 
-        instances = self._ec2.create_instances(
-            ImageId=resource.image,
-            KeyName=resource.key_name,
-            UserData=resource.user_data,
-            InstanceType=resource.flavor,
-            SubnetId=subnet_id,
-            MinCount=1,
-            MaxCount=1,
-            TagSpecifications=[{"ResourceType": "instance", "Tags": tags}],
-            EbsOptimized=resource.ebs_optimized,
-            BlockDeviceMappings=block_device_mapping,
-            **callargs,
+        # Virtual machines that only differ in their name are launched together
+        instance = InstanceLauncher.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        ).launch(
+            dict(
+                ImageId=resource.image,
+                KeyName=resource.key_name,
+                UserData=resource.user_data,
+                InstanceType=resource.flavor,
+                SubnetId=subnet_id,
+                EbsOptimized=resource.ebs_optimized,
+                BlockDeviceMappings=block_device_mapping,
+                **callargs,
+            ),
+            resource.name,
         )
-        if len(instances) != 1:
-            ctx.set_status(const.ResourceState.failed)
-            ctx.error(
-                "Requested one instance but do not receive it.", instances=instances
-            )
-            return
-
-        instance = instances[0]
-
-        for volumename in resource.volumes:
-            self.attach_for_name(
-                ctx, instance, volumename, resource.volume_attachment[volumename]
-            )
+        self._invalidate("instances", name=resource.name)
+        instance = self._ec2_object("Instance", instance["InstanceId"], instance)
 
         if not resource.source_dest_check:
             instance.modify_attribute(Attribute="sourceDestCheck", Value="False")
 
+        if resource.volumes:
+            names = sorted(resource.volumes)
+            instance = self._wait_until_attachable(ctx, resource, instance, names)
+            self._attach_volumes(ctx, resource, instance, names)
+
     def update_resource(
         self, ctx: HandlerContext, changes: dict, resource: VirtualMachine
     ) -> None:
@@ -834,11 +2423,9 @@ class VirtualMachineHandler(AWSHandler):
             toremove = set(current) - set(desired)
             if len(toremove) > 0 and not resource.ignore_extra_volumes:
                 ctx.warning("Handler will not detach storage!")
-            for volumename in toadd:
-                self.attach_for_name(
-                    ctx, instance, volumename, resource.volume_attachment[volumename]
-                )
-                todo -= 1
+            if toadd:
+                self._attach_volumes(ctx, resource, instance, sorted(toadd))
+            todo -= len(toadd)
 
         if "tags" in changes:
             current = changes["tags"]["current"]
@@ -848,6 +2435,7 @@ class VirtualMachineHandler(AWSHandler):
             }
             ctx.info("changing tags %(tags)s", tags=tochange)
             instance.create_tags(Tags=self.tags_internal_to_amazon(tochange))
+            self._invalidate("instances", name=resource.name)
             todo -= 1
 
         if "image" in changes and resource.ignore_wrong_image:
@@ -865,9 +2453,10 @@ class VirtualMachineHandler(AWSHandler):
                 )
             else:
                 rv = ctx.get("root_volume")
-                self._session.client("ec2").modify_volume(
+                self._get_aws_client("ec2").modify_volume(
                     VolumeId=rv.volume_id, Size=desired
                 )
+                self._invalidate("volumes", object_id=rv.volume_id)
                 todo -= 1
 
         if todo > 0:
@@ -876,38 +2465,129 @@ class VirtualMachineHandler(AWSHandler):
             )
             raise SkipResource("Modifying a running instance is not supported.")
 
-    def attach_for_name(self, ctx: HandlerContext, instance, volumename, device):
-        volume = [
-            x
-            for x in self._ec2.volumes.filter(
-                Filters=[{"Name": "tag:Name", "Values": [volumename]}]
+    def _wait_until_attachable(self, ctx: HandlerContext, resource, instance, names):
+        """
+        Wait until a new instance is no longer pending and the volumes with the given names are created. The waits
+        are served by the shared poller, in the same describe calls as the waits of the other handlers. The
+        resource is skipped when this takes longer than the configured timeout.
+
+        :return: The instance with its current state
+        """
+        waits = [
+            (
+                Waiter.for_operation(resource, "instance_running"),
+                "instances",
+                "instance-id",
+                instance.id,
+                lambda instances: len(instances) > 0
+                and all(x["State"]["Name"] != "pending" for x in instances),
             )
         ]
+        waiter = Waiter.for_operation(resource, "volume_available")
+        for name in names:
+            waits.append(
+                (
+                    waiter,
+                    "volumes",
+                    "tag:Name",
+                    name,
+                    lambda volumes: all(x["State"] != "creating" for x in volumes),
+                )
+            )
 
-        if len(volume) != 1:
-            ctx.error(
-                "Found more than one volume with tag Name %(name)s",
-                name=volumename,
-                instances=instance,
-                volumes=volume,
+        try:
+            instances = self._poller.wait_all(waits, ctx)[0]
+        except WaitTimeout:
+            raise SkipResource(
+                f"Instance {instance.id} or its volumes are not ready yet, its volumes are attached in a later deploy"
             )
-            raise SkipResource()
+        self._invalidate("instances", name=resource.name)
+        return self._ec2_object("Instance", instance.id, instances[0])
+
+    def _attach_volumes(self, ctx: HandlerContext, resource, instance, names):
+        """
+        Attach the volumes with the given names to an instance. The volumes are looked up in one describe call and
+        attached concurrently. A create first waits for the instance and its volumes with _wait_until_attachable.
+        When the instance or a volume is still not ready, the resource is skipped, so a later deploy attaches them.
+        """
+        volumes = {}
+        for volume in describe_ec2(
+            self._get_aws_client("ec2"), "volumes", "tag:Name", names
+        ):
+            volumes.setdefault(ec2_object_name("volumes", volume), []).append(volume)
+
+        for name in names:
+            if len(volumes.get(name, [])) != 1:
+                ctx.error(
+                    "Expected exactly one volume with tag Name %(name)s",
+                    name=name,
+                    instances=instance,
+                    volumes=volumes.get(name, []),
+                )
+                raise SkipResource()
 
-        volume = volume[0]
+        if instance.state["Name"] not in ("running", "stopped"):
+            raise SkipResource(
+                f"Instance {instance.id} is {instance.state['Name']}, waiting to attach its volumes"
+            )
 
-        instance.attach_volume(VolumeId=volume.id, Device=device)
+        not_ready = [name for name in names if volumes[name][0]["State"] != "available"]
+        if not_ready:
+            raise SkipResource(f"Volumes {', '.join(not_ready)} are not available yet")
+
+        client = self._get_aws_client("ec2")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(names)) as executor:
+            futures = {
+                name: executor.submit(
+                    client.attach_volume,
+                    InstanceId=instance.id,
+                    VolumeId=volumes[name][0]["VolumeId"],
+                    Device=resource.volume_attachment[name],
+                )
+                for name in names
+            }
+        for name in names:
+            self._invalidate("volumes", name=name)
+
+        errors = {name: f.exception() for name, f in futures.items() if f.exception()}
+        if errors:
+            for name, error in errors.items():
+                ctx.error(
+                    "Failed to attach volume %(name)s", name=name, error=str(error)
+                )
+            raise Exception(f"Failed to attach volumes {', '.join(sorted(errors))}")
 
     def delete_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
         instance = ctx.get("instance")
-        instance.terminate()
+        terminator = InstanceTerminator.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        )
+        if instance.state["Name"] != "shutting-down":
+            terminator.terminate(instance.id)
+            self._invalidate("instances", name=resource.name)
 
-        count = 0
-        while instance.state["Name"] != "terminated" and count < 120:
-            count += 1
-            time.sleep(5)
-            instance.reload()
+        if not resource.wait_for_termination:
+            # The next deploy finds the instance terminated and reports the resource as purged
+            ctx.info(
+                "Instance %(instance)s is shutting down, not waiting for it to terminate",
+                instance=instance.id,
+            )
+            raise SkipResource(f"Instance {instance.id} is shutting down")
 
-        if instance.state["Name"] != "terminated":
+        try:
+            # Terminated instances disappear from the describe results after a while
+            self._poller.wait(
+                Waiter.for_operation(resource, "instance_terminated"),
+                "instances",
+                "instance-id",
+                instance.id,
+                lambda instances: all(
+                    x["State"]["Name"] == "terminated" for x in instances
+                ),
+                ctx,
+            )
+        except WaitTimeout:
+            instance.reload()
             raise Exception(
                 f"Timeout: Instance didn't get into terminated state (current_state={instance.state['Name']})"
             )
@@ -917,10 +2597,8 @@ class VirtualMachineHandler(AWSHandler):
 
         instance = [
             x
-            for x in self._ec2.instances.filter(
-                Filters=[{"Name": "tag:Name", "Values": [resource.name]}]
-            )
-            if x.state["Name"] != "terminated"
+            for x in self._inventory.get("instances", resource.name)
+            if x["State"]["Name"] != "terminated"
         ]
         if len(instance) == 0:
             return {}
@@ -933,7 +2611,7 @@ class VirtualMachineHandler(AWSHandler):
             )
             raise SkipResource()
 
-        instance = instance[0]
+        instance = self._ec2_object("Instance", instance[0]["InstanceId"], instance[0])
 
         # find eth0
         iface = None
@@ -959,13 +2637,10 @@ class VirtualMachineHandler(AWSHandler):
 
 @provider("aws::Volume", name="volume")
 class VolumeHandler(AWSHandler):
+    inventory_kind = "volumes"
+
     def read_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
-        instance = [
-            x
-            for x in self._ec2.volumes.filter(
-                Filters=[{"Name": "tag:Name", "Values": [resource.name]}]
-            )
-        ]
+        instance = self._inventory.get("volumes", resource.name)
 
         if len(instance) == 0:
             raise ResourcePurged()
@@ -978,7 +2653,7 @@ class VolumeHandler(AWSHandler):
             )
             raise SkipResource()
 
-        instance = instance[0]
+        instance = self._ec2_object("Volume", instance[0]["VolumeId"], instance[0])
         ctx.set("instance", instance)
         resource.purged = False
         resource.volume_type = instance.volume_type
@@ -1006,6 +2681,7 @@ class VolumeHandler(AWSHandler):
             DryRun=False,
             TagSpecifications=[{"ResourceType": "volume", "Tags": tags}],
         )
+        self._invalidate("volumes", name=resource.name)
 
         if instances is None:
             ctx.set_status(const.ResourceState.failed)
@@ -1023,28 +2699,42 @@ class VolumeHandler(AWSHandler):
 
     def delete_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
         ctx.get("instance").delete()
+        self._invalidate("volumes", name=resource.name)
         ctx.set_purged()
 
 
 @provider("aws::analytics::ElasticSearch", name="elasticsearch")
 class ElasticSearchHandler(AWSHandler):
+    # The sections of the domain config and the fields they contain
+    CONFIG_SECTIONS = {
+        "ElasticsearchClusterConfig": (
+            "instance_type",
+            "instance_count",
+            "dedicated_master_enabled",
+            "zone_awareness_enabled",
+            "dedicated_master_type",
+            "dedicated_master_count",
+        ),
+        "EBSOptions": ("ebs_enabled", "volume_type", "volume_size"),
+        "AccessPolicies": ("access_policies",),
+        "SnapshotOptions": ("automated_snapshot_start_hour",),
+    }
+
     def pre(self, ctx: HandlerContext, resource: AWSResource) -> None:
         AWSHandler.pre(self, ctx, resource)
-        self._es = self._session.client("es")
+        self._es = self._get_aws_client("es")
+        self._domains = ElasticSearchIndex.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        )
+        self._domains.register(resource.domain_name)
 
     def read_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
-        try:
-            instance = self._es.describe_elasticsearch_domain(
-                DomainName=resource.domain_name
-            )["DomainStatus"]
-        except self._es.exceptions.ResourceNotFoundException:
+        instance = self._domains.get(resource.domain_name)
+        if instance is None:
             raise ResourcePurged()
 
-        ctx.warning(
-            "Found instance %(mytype)s %(instance)s",
-            mytype=str(type(instance)),
-            instance=instance,
-        )
+        if resource.provider["log_api_responses"]:
+            ctx.debug("Found domain %(instance)s", instance=instance)
         ctx.set("instance", instance)
 
         resource.elasticsearch_version = instance["ElasticsearchVersion"]
@@ -1149,14 +2839,41 @@ class ElasticSearchHandler(AWSHandler):
                 "AutomatedSnapshotStartHour": resource.automated_snapshot_start_hour
             },
         )
+        self._domains.invalidate(resource.domain_name)
         ctx.info("Create new Elastic Search")
         ctx.set_created()
 
     def update_resource(
         self, ctx: HandlerContext, changes: dict, resource: VirtualMachine
     ) -> None:
-        ctx.info("pushing diff %(diff)s", diff=changes)
-        self._es.update_elasticsearch_domain_config(**self.convert_resource(resource))
+        if ctx.get("instance").get("Processing"):
+            # Sending the update again would start yet another change of the domain
+            raise SkipResource(
+                f"Domain {resource.domain_name} is still applying a configuration change"
+            )
+
+        if "elasticsearch_version" in changes:
+            ctx.warning(
+                "Upgrading the version of domain %(domain)s is not supported",
+                domain=resource.domain_name,
+            )
+
+        # Only send the sections that changed, any change to the config can trigger a redeploy of the domain
+        config = self.convert_resource(resource)
+        sections = [
+            section
+            for section, fields in self.CONFIG_SECTIONS.items()
+            if any(field in changes for field in fields)
+        ]
+        if not sections:
+            return
+
+        ctx.info("pushing diff %(diff)s", diff=changes, sections=sections)
+        self._es.update_elasticsearch_domain_config(
+            DomainName=resource.domain_name,
+            **{section: config[section] for section in sections},
+        )
+        self._domains.invalidate(resource.domain_name)
         ctx.set_updated()
 
     def delete_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
@@ -1164,15 +2881,15 @@ class ElasticSearchHandler(AWSHandler):
 
     def facts(self, ctx, resource):
         facts = {}
-        try:
-            instance = self._es.describe_elasticsearch_domain(
-                DomainName=resource.domain_name
-            )["DomainStatus"]
-            facts["endpoint"] = instance["Endpoint"]
-            facts["arn"] = instance["ARN"]
-            facts["id"] = instance["DomainId"]
-        except self._es.exceptions.ResourceNotFoundException:
+        instance = self._domains.get(resource.domain_name)
+        if instance is None:
             return facts
+
+        # The endpoint is only known once the domain is created
+        if "Endpoint" in instance:
+            facts["endpoint"] = instance["Endpoint"]
+        facts["arn"] = instance["ARN"]
+        facts["id"] = instance["DomainId"]
         return facts
 
 
@@ -1180,34 +2897,19 @@ class ElasticSearchHandler(AWSHandler):
 class RDSHandler(AWSHandler):
     def pre(self, ctx: HandlerContext, resource: AWSResource) -> None:
         AWSHandler.pre(self, ctx, resource)
-        self._rds = self._session.client("rds")
+        self._rds = self._get_aws_client("rds")
+        self._databases = DatabaseIndex.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        )
+        self._databases.register(resource.name)
 
     def read_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
-        try:
-            instances = self._rds.describe_db_instances(
-                DBInstanceIdentifier=resource.name
-            )["DBInstances"]
-        except Exception:
-            raise ResourcePurged()
-
-        if len(instances) == 0:
+        instance = self._databases.get(resource.name)
+        if instance is None:
             raise ResourcePurged()
 
-        elif len(instances) > 1:
-            ctx.info(
-                "Found more than one RDS instance with name %(name)s",
-                name=resource.name,
-                instances=instances,
-            )
-            raise SkipResource()
-
-        instance = instances[0]
-
-        ctx.warning(
-            "Found instance %(mytype)s %(instance)s",
-            mytype=str(type(instance)),
-            instance=instance,
-        )
+        if resource.provider["log_api_responses"]:
+            ctx.debug("Found instance %(instance)s", instance=instance)
         ctx.set("instance", instance)
 
         resource.flavor = instance["DBInstanceClass"]
@@ -1219,11 +2921,7 @@ class RDSHandler(AWSHandler):
         resource.port = instance["Endpoint"]["Port"]
         resource.public = instance["PubliclyAccessible"]
 
-        arn = instance["DBInstanceArn"]
-
-        tags = self._rds.list_tags_for_resource(ResourceName=arn)["TagList"]
-
-        resource.tags = self.tags_amazon_to_internal(tags)
+        resource.tags = self.tags_amazon_to_internal(instance.get("TagList", []))
 
     def create_resource(self, ctx: HandlerContext, resource: VirtualMachine) -> None:
         db = self._rds.create_db_instance(
@@ -1239,6 +2937,7 @@ class RDSHandler(AWSHandler):
             PubliclyAccessible=resource.public,
             Tags=self.tags_internal_to_amazon(resource.tags),
         )
+        self._databases.invalidate(resource.name)
         ctx.info(
             "Create new db with id %(id)s", id=db["DBInstance"]["DBInstanceIdentifier"]
         )
@@ -1254,15 +2953,10 @@ class RDSHandler(AWSHandler):
 
     def facts(self, ctx, resource):
         facts = {}
-        instances = self._rds.describe_db_instances(DBInstanceIdentifier=resource.name)[
-            "DBInstances"
-        ]
-
-        if len(instances) != 1:
+        instance = self._databases.get(resource.name)
+        if instance is None or "Endpoint" not in instance:
             return facts
 
-        instance = instances[0]
-
         facts["endpoint"] = instance["Endpoint"]["Address"]
         facts["arn"] = instance["DBInstanceArn"]
         return facts
@@ -1270,13 +2964,10 @@ class RDSHandler(AWSHandler):
 
 @provider("aws::VPC", name="ec2")
 class VPCHandler(AWSHandler):
-    def _get_vpc(self, name):
-        return list(
-            self._ec2.vpcs.filter(Filters=[{"Name": "tag:Name", "Values": [name]}])
-        )
+    inventory_kind = "vpcs"
 
     def read_resource(self, ctx: HandlerContext, resource: VPC) -> None:
-        vpcs = self._get_vpc(resource.name)
+        vpcs = self._inventory.get("vpcs", resource.name)
         if len(vpcs) == 0:
             raise ResourcePurged()
 
@@ -1288,7 +2979,7 @@ class VPCHandler(AWSHandler):
             )
             raise SkipResource()
 
-        vpc = vpcs[0]
+        vpc = self._ec2_object("Vpc", vpcs[0]["VpcId"], vpcs[0])
         ctx.set("vpc", vpc)
 
         resource.cidr_block = vpc.cidr_block
@@ -1297,24 +2988,13 @@ class VPCHandler(AWSHandler):
 
     def create_resource(self, ctx: HandlerContext, resource: VPC) -> None:
         vpc = self._ec2.create_vpc(
-            CidrBlock=resource.cidr_block, InstanceTenancy=resource.instance_tenancy
+            CidrBlock=resource.cidr_block,
+            InstanceTenancy=resource.instance_tenancy,
+            TagSpecifications=self._name_tag_specification("vpc", resource.name),
         )
+        self._ensure_name_tag(ctx, resource, vpc, "VPC")
 
-        # This method tends to hit eventual consistency problem returning an error that the subnet does not exist
-        tries = 5
-        tag_creation_succeeded = False
-        while not tag_creation_succeeded and tries > 0:
-            try:
-                vpc.create_tags(Tags=[{"Key": "Name", "Value": resource.name}])
-                tag_creation_succeeded = True
-            except botocore.exceptions.ClientError:
-                time.sleep(1)
-            tries -= 1
-
-        if not tag_creation_succeeded:
-            vpc.delete()
-            raise Exception(f"Failed to associate tag with VPC {vpc.id}")
-
+        self._invalidate("vpcs", name=resource.name)
         ctx.info("Create new vpc with id %(id)s", id=vpc.id)
         ctx.set_created()
 
@@ -1327,15 +3007,23 @@ class VPCHandler(AWSHandler):
         vpc = ctx.get("vpc")
         ctx.info("Purging vpc %(id)s", id=vpc.id)
         vpc.delete()
+        self._invalidate("vpcs", name=resource.name)
         ctx.set_purged()
 
 
 @provider("aws::Route", name="ec2")
 class RouteHandler(AWSHandler):
-    def _get_vpc(self, name):
-        return list(
-            self._ec2.vpcs.filter(Filters=[{"Name": "tag:Name", "Values": [name]}])
+    def pre(self, ctx: HandlerContext, resource: AWSResource) -> None:
+        AWSHandler.pre(self, ctx, resource)
+        self._network = VpcNetworkIndex.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
         )
+        self._routes = RouteReconciler.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        )
+
+    def _get_vpc(self, name):
+        return [self._ec2.Vpc(x) for x in self._resolver.resolve_one("vpcs", name)]
 
     def read_resource(self, ctx: HandlerContext, resource: Route) -> None:
         vpcs = self._get_vpc(resource.vpc)
@@ -1357,13 +3045,15 @@ class RouteHandler(AWSHandler):
 
         vpc = vpcs[0]
         ctx.set("vpc", vpc)
+        network = self._network.get(vpc.id)
 
         # Find the ENI that is associated with the desired nexthop
-        enis = list(
-            vpc.network_interfaces.filter(
-                Filters=[{"Name": "private-ip-address", "Values": [resource.nexthop]}]
-            )
-        )
+        enis = network["enis"].get(resource.nexthop, [])
+        if len(enis) == 0:
+            # The nexthop may be a virtual machine that was created after the index was built
+            self._network.invalidate(vpc.id)
+            network = self._network.get(vpc.id)
+            enis = network["enis"].get(resource.nexthop, [])
 
         if len(enis) == 0:
             ctx.info(
@@ -1382,7 +3072,7 @@ class RouteHandler(AWSHandler):
         ctx.set("eni", eni)
 
         # Find the route entry in the main routing table of the VPC
-        route_tables = list(vpc.route_tables.all())
+        route_tables = network["route_tables"]
         if len(route_tables) > 1:
             ctx.info(
                 "Found more than one route table in vpc with tag Name %(name)s. Only one is supported currently.",
@@ -1393,56 +3083,47 @@ class RouteHandler(AWSHandler):
         route_table = route_tables[0]
         ctx.set("route_table", route_table)
 
-        route = None
-        for rt in route_table.routes:
-            if rt.destination_cidr_block == resource.destination:
-                route = rt
-                break
-
+        route = route_table["routes"].get(resource.destination)
         if route is None:
             raise ResourcePurged()
 
         ctx.set("route", route)
 
-        if route.network_interface_id != eni.id:
+        if route.get("NetworkInterfaceId") != eni["NetworkInterfaceId"]:
             resource.nexthop = ""
 
         resource.purged = False
 
-    def create_resource(self, ctx: HandlerContext, resource: Route) -> None:
-        route_table = ctx.get("route_table")
-        eni = ctx.get("eni")
-        route_table.create_route(
-            DestinationCidrBlock=resource.destination, NetworkInterfaceId=eni.id
+    def _set_route(self, ctx, resource, eni_id):
+        return self._routes.set_route(
+            self._network,
+            ctx.get("vpc").id,
+            ctx.get("route_table"),
+            resource.destination,
+            eni_id,
         )
+
+    def create_resource(self, ctx: HandlerContext, resource: Route) -> None:
+        self._set_route(ctx, resource, ctx.get("eni")["NetworkInterfaceId"])
         ctx.set_created()
 
     def update_resource(
         self, ctx: HandlerContext, changes: dict, resource: Route
     ) -> None:
-        rt = ctx.get("route")
-        rt.delete()
-        route_table = ctx.get("route_table")
-        eni = ctx.get("eni")
-        route_table.create_route(
-            DestinationCidrBlock=resource.destination, NetworkInterfaceId=eni.id
-        )
+        self._set_route(ctx, resource, ctx.get("eni")["NetworkInterfaceId"])
         ctx.set_updated()
 
     def delete_resource(self, ctx: HandlerContext, resource: Route) -> None:
-        rt = ctx.get("route")
-        rt.delete()
+        self._set_route(ctx, resource, None)
         ctx.set_purged()
 
 
 @provider("aws::Subnet", name="ec2")
 class SubnetHandler(AWSHandler):
+    inventory_kind = "subnets"
+
     def read_resource(self, ctx: HandlerContext, resource: Subnet) -> None:
-        subnets = list(
-            self._ec2.subnets.filter(
-                Filters=[{"Name": "tag:Name", "Values": [resource.name]}]
-            )
-        )
+        subnets = self._inventory.get("subnets", resource.name)
         if len(subnets) == 0:
             raise ResourcePurged()
 
@@ -1454,22 +3135,17 @@ class SubnetHandler(AWSHandler):
             )
             raise SkipResource()
 
-        subnet = subnets[0]
+        subnet = self._ec2_object("Subnet", subnets[0]["SubnetId"], subnets[0])
         ctx.set("subnet", subnet)
         resource.purged = False
         resource.cidr_block = subnet.cidr_block
         resource.availability_zone = subnet.availability_zone
         resource.map_public_ip_on_launch = subnet.map_public_ip_on_launch
 
-        vpc_tag = [x for x in subnet.vpc.tags if x["Key"] == "Name"]
-        resource.vpc = vpc_tag[0]["Value"]
+        resource.vpc = self._resolver.name_of("vpcs", subnet.vpc_id)
 
     def create_resource(self, ctx: HandlerContext, resource: Subnet) -> None:
-        vpcs = list(
-            self._ec2.vpcs.filter(
-                Filters=[{"Name": "tag:Name", "Values": [resource.vpc]}]
-            )
-        )
+        vpcs = self._resolver.resolve_one("vpcs", resource.vpc)
 
         if len(vpcs) == 0:
             raise SkipResource("The vpc for this subnet is not available.")
@@ -1477,39 +3153,38 @@ class SubnetHandler(AWSHandler):
         elif len(vpcs) > 1:
             raise SkipResource("Multiple VPCs with the same name tag found.")
 
-        vpc = vpcs[0]
-        args = {"VpcId": vpc.id, "CidrBlock": resource.cidr_block}
+        args = {
+            "VpcId": vpcs[0],
+            "CidrBlock": resource.cidr_block,
+            "TagSpecifications": self._name_tag_specification("subnet", resource.name),
+        }
         if resource.availability_zone is not None:
             args["AvailabilityZone"] = resource.availability_zone
 
-        tries = 5
-        while tries > 0:
-            try:
-                subnet = self._ec2.create_subnet(**args)
-            except botocore.exceptions.ClientError:
-                tries -= 1
-                if tries > 0:
-                    ctx.info("An exception ocurred, retrying", exc_info=True)
-                    time.sleep(5)
-                else:
-                    raise
-            else:
-                break
-
-        # This method tends to hit eventual consistency problem returning an error that the subnet does not exist
-        tries = 5
-        tag_creation_succeeded = False
-        while not tag_creation_succeeded and tries > 0:
-            try:
-                subnet.create_tags(Tags=[{"Key": "Name", "Value": resource.name}])
-                tag_creation_succeeded = True
-            except botocore.exceptions.ClientError:
-                time.sleep(5)
-            tries -= 1
+        attempts = []
+
+        def create_subnet():
+            # CreateSubnet has no client token. Because the subnet is tagged when it is created, a retry can find
+            # the subnet of an earlier attempt that failed after all and use that one.
+            if attempts:
+                existing = list(
+                    self._ec2.subnets.filter(
+                        Filters=[
+                            {"Name": "tag:Name", "Values": [resource.name]},
+                            {"Name": "vpc-id", "Values": [vpcs[0]]},
+                            {"Name": "cidr-block", "Values": [resource.cidr_block]},
+                        ]
+                    )
+                )
+                if existing:
+                    return existing[0]
+            attempts.append(1)
+            return self._ec2.create_subnet(**args)
 
-        if not tag_creation_succeeded:
-            subnet.delete()
-            raise Exception(f"Failed to associate tag with subnet {subnet.id}")
+        subnet = Waiter.for_operation(resource, "create_subnet").call(
+            create_subnet, ctx=ctx
+        )
+        self._ensure_name_tag(ctx, resource, subnet, "subnet")
 
         if subnet.map_public_ip_on_launch != resource.map_public_ip_on_launch:
             subnet.meta.client.modify_subnet_attribute(
@@ -1517,6 +3192,7 @@ class SubnetHandler(AWSHandler):
                 MapPublicIpOnLaunch={"Value": resource.map_public_ip_on_launch},
             )
 
+        self._invalidate("subnets", name=resource.name)
         ctx.info("Created new subnet with id %(id)s", id=subnet.id)
         ctx.set_created()
 
@@ -1529,12 +3205,14 @@ class SubnetHandler(AWSHandler):
                 SubnetId=subnet.id,
                 MapPublicIpOnLaunch={"Value": resource.map_public_ip_on_launch},
             )
+            self._invalidate("subnets", name=resource.name)
             ctx.set_updated()
 
     def delete_resource(self, ctx: HandlerContext, resource: Subnet) -> None:
         subnet = ctx.get("subnet")
         ctx.info("Purging subnet %(id)s", id=subnet.id)
         subnet.delete()
+        self._invalidate("subnets", name=resource.name)
         ctx.set_purged()
 
 
@@ -1563,24 +3241,14 @@ class InternetGatewayHandler(AWSHandler):
 
         vpc = None
         if len(igw.attachments) > 0 and "VpcId" in igw.attachments[0]:
-            data = igw.attachments[0]
-            try:
-                vpc = list(self._ec2.vpcs.filter(VpcIds=[data["VpcId"]]))[0]
-                tags = [x for x in vpc.tags if x["Key"] == "Name"]
-                if len(tags) > 0:
-                    resource.vpc = tags[0]["Value"]
-                else:
-                    resource.vpc = None
-            except botocore.exceptions.ClientError:
-                resource.vpc = None
+            vpc = self._ec2.Vpc(igw.attachments[0]["VpcId"])
+            resource.vpc = self._resolver.name_of("vpcs", vpc.id)
         else:
             resource.vpc = None
         ctx.set("vpc", vpc)
 
     def get_vpc(self, name):
-        vpcs = list(
-            self._ec2.vpcs.filter(Filters=[{"Name": "tag:Name", "Values": [name]}])
-        )
+        vpcs = self._resolver.resolve_one("vpcs", name)
 
         if len(vpcs) == 0:
             raise SkipResource("The vpc for this internet gateway is not available.")
@@ -1588,10 +3256,10 @@ class InternetGatewayHandler(AWSHandler):
         elif len(vpcs) > 1:
             raise SkipResource("Multiple VPCs with the same name tag found.")
 
-        return vpcs[0]
+        return self._ec2.Vpc(vpcs[0])
 
     def create_resource(self, ctx: HandlerContext, resource: InternetGateway) -> None:
-        vpc = self.get_vpc(resource.name)
+        vpc = self.get_vpc(resource.vpc)
         igw = self._ec2.create_internet_gateway(
             TagSpecifications=[
                 {
@@ -1600,44 +3268,87 @@ class InternetGatewayHandler(AWSHandler):
                 },
             ]
         )
-        self._wait_until_creation_is_done(resource.name)
+        self._wait_until_creation_is_done(ctx, resource)
         igw.attach_to_vpc(VpcId=vpc.id)
         ctx.info("Created new internet gateway with id %(id)s", id=igw.id)
 
-        # Check that all VPC route tables have a default route to us
-        for tbl in vpc.route_tables.all():
-            has_default = False
-            for rt in tbl.routes:
-                if rt.destination_cidr_block == "0.0.0.0/0":
-                    has_default = True
+        self._add_default_routes(ctx, resource, vpc, igw)
+        ctx.set_created()
+
+    def _add_default_routes(self, ctx, resource, vpc, igw):
+        """
+        Make sure every route table of the vpc has a default route. The route tables are described in one call and
+        the default routes that are missing are added concurrently, through the new internet gateway.
+        """
+        client = self._get_aws_client("ec2")
+        paginator = client.get_paginator("describe_route_tables")
+        missing = [
+            table["RouteTableId"]
+            for page in paginator.paginate(
+                Filters=[{"Name": "vpc-id", "Values": [vpc.id]}]
+            )
+            for table in page["RouteTables"]
+            if not any(
+                route.get("DestinationCidrBlock") == "0.0.0.0/0"
+                for route in table["Routes"]
+            )
+        ]
+        if not missing:
+            return
 
-            if not has_default:
-                tbl.create_route(DestinationCidrBlock="0.0.0.0/0", GatewayId=igw.id)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(missing), 10)
+        ) as executor:
+            futures = {
+                table_id: executor.submit(
+                    client.create_route,
+                    RouteTableId=table_id,
+                    DestinationCidrBlock="0.0.0.0/0",
+                    GatewayId=igw.id,
+                )
+                for table_id in missing
+            }
+        VpcNetworkIndex.for_provider(
+            self._credentials, resource.provider["cache_ttl"]
+        ).invalidate(vpc.id)
 
-        ctx.set_created()
+        errors = {
+            table_id: f.exception() for table_id, f in futures.items() if f.exception()
+        }
+        if errors:
+            for table_id, error in errors.items():
+                ctx.error(
+                    "Failed to add a default route to route table %(table)s",
+                    table=table_id,
+                    error=str(error),
+                )
+            raise Exception(
+                f"Failed to add a default route to route tables {', '.join(sorted(errors))}"
+            )
 
     def _wait_until_creation_is_done(
-        self, resource_name: str, timeout: int = 120
+        self, ctx: HandlerContext, resource: InternetGateway
     ) -> None:
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            igws = list(
-                self._ec2.internet_gateways.filter(
-                    Filters=[{"Name": "tag:Name", "Values": [resource_name]}]
-                )
+        waiter = Waiter.for_operation(resource, "internet_gateway")
+        try:
+            self._poller.wait(
+                waiter,
+                "internet_gateways",
+                "tag:Name",
+                resource.name,
+                lambda igws: len(igws) > 0,
+                ctx,
+            )
+        except WaitTimeout:
+            raise Exception(
+                f"Timeout: waiting for creation internet gateway {resource.name} after {waiter.timeout}sec"
             )
-            if igws:
-                return
-            time.sleep(1)
-        raise Exception(
-            f"Timeout: waiting for creation internet gateway {resource_name} after {timeout}sec"
-        )
 
     def update_resource(
         self, ctx: HandlerContext, changes: dict, resource: InternetGateway
     ) -> None:
         igw = ctx.get("igw")
-        vpc = self.get_vpc(resource.name)
+        vpc = self.get_vpc(resource.vpc)
         igw.attach_to_vpc(VpcId=vpc.id)
         ctx.set_updated()
 
@@ -1649,86 +3360,117 @@ class InternetGatewayHandler(AWSHandler):
         ctx.set_purged()
 
 
-@provider("aws::SecurityGroup", name="ec2")
-class SecurityGroupHandler(AWSHandler):
-    def _compare_rule(self, old, new):
-        old_keys = old.keys()
-        new_keys = new.keys()
+# The maximum number of rules to authorize or revoke in one call
+MAX_RULES_PER_CALL = 100
+
+
+def rule_key(rule):
+    """
+    Get a hashable form of a security group rule in which rules that EC2 considers equal are equal.
+    """
+    protocol = str(rule["protocol"]).lower()
+    if protocol == "-1":
+        protocol = "all"
+
+    if protocol == "all":
+        # EC2 ignores the ports of a rule for all protocols
+        port_min, port_max = -1, -1
+    else:
+        port_min = rule.get("port_range_min", -1)
+        port_max = rule.get("port_range_max", -1)
+        port_min = -1 if port_min is None else int(port_min)
+        port_max = -1 if port_max is None else int(port_max)
+        # For icmp the ports are the type and code, where 0 is a valid value
+        if protocol not in ("icmp", "icmpv6"):
+            port_min = -1 if port_min == 0 else port_min
+            port_max = -1 if port_max == 0 else port_max
+
+    return (
+        rule["direction"],
+        protocol,
+        port_min,
+        port_max,
+        rule.get("remote_ip_prefix"),
+        rule.get("remote_group"),
+    )
 
-        if old_keys != new_keys:
-            return False
 
-        for key in old_keys:
-            if old[key] != new[key]:
-                return False
+def diff_rules(current, desired):
+    """
+    Compare two lists of security group rules and return the rules to add and to remove. Duplicate rules are
+    counted, so a rule that is listed twice in current but once in desired is removed once.
+    """
+    current_rules = collections.Counter()
+    desired_rules = collections.Counter()
+    rules = {}
+    for rule in current:
+        key = rule_key(rule)
+        current_rules[key] += 1
+        rules.setdefault(key, rule)
+    for rule in desired:
+        key = rule_key(rule)
+        desired_rules[key] += 1
+        rules.setdefault(key, rule)
+
+    add = [rules[key] for key in (desired_rules - current_rules).elements()]
+    remove = [rules[key] for key in (current_rules - desired_rules).elements()]
+    return add, remove
 
-        return True
 
+@provider("aws::SecurityGroup", name="ec2")
+class SecurityGroupHandler(AWSHandler):
     def _diff(self, current, desired):
         changes = AWSHandler._diff(self, current, desired)
 
         if "rules" in changes:
-            old_rules = list(changes["rules"]["current"])
-            new_rules = list(changes["rules"]["desired"])
-
-            for new_rule in changes["rules"]["desired"]:
-                for old_rule in changes["rules"]["current"]:
-                    if self._compare_rule(old_rule, new_rule):
-                        old_rules.remove(old_rule)
-                        new_rules.remove(new_rule)
-                        break
-
-            if len(old_rules) == 0 and len(new_rules) == 0:
+            add_rules, remove_rules = diff_rules(
+                changes["rules"]["current"], changes["rules"]["desired"]
+            )
+            if len(add_rules) == 0 and len(remove_rules) == 0:
                 del changes["rules"]
 
         return changes
 
-    def _build_rule(self, ctx, rule, direction):
-        current_rule = {}
-        if rule["IpProtocol"] == "-1":
-            current_rule["protocol"] = "all"
-        else:
-            current_rule["protocol"] = rule["IpProtocol"]
-
-        current_rule["direction"] = direction
-        current_rule["port_range_min"] = rule.get("FromPort", -1)
-        current_rule["port_range_max"] = rule.get("ToPort", -1)
-
-        rules = []
-        if rule["IpRanges"] is not None:
-            for ip_range in rule["IpRanges"]:
-                r = current_rule.copy()
-                r["remote_ip_prefix"] = ip_range["CidrIp"]
-                rules.append(r)
-
-        elif rule["UserIdGroupPairs"] is not None:
-            if len(rule["UserIdGroupPairs"]) > 1:
-                ctx.warning(
-                    "More than one security group source per rule is not support, only using the first group",
-                    groups=rule["UserIdGroupPairs"],
-                )
+    def _build_rule(self, ctx, rule, group_names):
+        """
+        Convert a rule of describe_security_group_rules. The rule keeps its id, so it can be revoked by id.
+        """
+        current_rule = {
+            "rule_id": rule["SecurityGroupRuleId"],
+            "direction": "egress" if rule["IsEgress"] else "ingress",
+            "protocol": "all" if rule["IpProtocol"] == "-1" else rule["IpProtocol"],
+            "port_range_min": rule.get("FromPort", -1),
+            "port_range_max": rule.get("ToPort", -1),
+        }
 
-            rgi = self._get_security_group(
-                ctx, group_id=rule["UserIdGroupPairs"][0]["GroupId"]
-            )
-            current_rule["remote_group"] = rgi.name
-            rules.append(rgi)
+        if "CidrIpv4" in rule:
+            current_rule["remote_ip_prefix"] = rule["CidrIpv4"]
+        elif "ReferencedGroupInfo" in rule:
+            group_id = rule["ReferencedGroupInfo"]["GroupId"]
+            # A group outside of the vpc keeps its id, so the rule is never mistaken for one in the model
+            current_rule["remote_group"] = group_names.get(group_id, group_id)
+        elif "CidrIpv6" in rule or "PrefixListId" in rule:
+            # The model has no ipv6 or prefix list rules, these are left alone
+            ctx.debug("Ignoring rule %(rule_id)s", rule_id=rule["SecurityGroupRuleId"])
+            return None
         else:
-            ctx.error(
-                "No idea what to do with this rule", rule=rule, direction=direction
-            )
+            ctx.error("No idea what to do with this rule", rule=rule)
+            return None
 
-        return rules
+        return current_rule
 
-    def _build_current_rules(self, ctx, security_group):
+    def _build_current_rules(self, ctx, security_group, group_names):
         rules = []
-        for rule in security_group.ip_permissions:
-            current_rule = self._build_rule(ctx, rule, "ingress")
-            rules.extend(current_rule)
-
-        for rule in security_group.ip_permissions_egress:
-            current_rule = self._build_rule(ctx, rule, "egress")
-            rules.extend(current_rule)
+        paginator = self._get_aws_client("ec2").get_paginator(
+            "describe_security_group_rules"
+        )
+        for page in paginator.paginate(
+            Filters=[{"Name": "group-id", "Values": [security_group.id]}]
+        ):
+            for rule in page["SecurityGroupRules"]:
+                current_rule = self._build_rule(ctx, rule, group_names)
+                if current_rule is not None:
+                    rules.append(current_rule)
 
         return rules
 
@@ -1744,38 +3486,36 @@ class SecurityGroupHandler(AWSHandler):
 
         ctx.set("vpc", vpc)
 
-        sgs = list(
-            vpc.security_groups.filter(
-                Filters=[
-                    {"Name": "group-name", "Values": [resource.name]},
-                    {"Name": "vpc-id", "Values": [vpc.id]},
-                ]
+        # Index all groups of the vpc, to resolve the groups the rules refer to
+        groups = list(
+            describe_ec2(
+                self._get_aws_client("ec2"), "security_groups", "vpc-id", [vpc.id]
             )
         )
+        group_ids = {group["GroupName"]: group["GroupId"] for group in groups}
+        ctx.set("group_ids", group_ids)
+
+        sgs = [group for group in groups if group["GroupName"] == resource.name]
         if len(sgs) == 0:
             raise ResourcePurged()
 
-        sg = sgs[0]
+        sg = self._ec2_object("SecurityGroup", sgs[0]["GroupId"], sgs[0])
         ctx.set("sg", sg)
         resource.purged = False
         resource.description = sg.description
-        resource.rules = self._build_current_rules(ctx, sg)
+        resource.rules = self._build_current_rules(
+            ctx, sg, {group_id: name for name, group_id in group_ids.items()}
+        )
 
         # Verify if correct vpc
-        vpc = list(self._ec2.vpcs.filter(VpcIds=[sg.vpc_id]))
-        if len(vpc) == 0:
-            raise Exception("Invalid response from Amazon API?!?")
-
-        tags = [x for x in vpc[0].tags if x["Key"] == "Name"]
-        if len(tags) > 0:
-            resource.vpc = tags[0]["Value"]
+        vpc_name = self._resolver.name_of("vpcs", sg.vpc_id)
+        if vpc_name is not None:
+            resource.vpc = vpc_name
         else:
             resource.vpc = "No name."
 
     def get_vpc(self, name):
-        vpcs = list(
-            self._ec2.vpcs.filter(Filters=[{"Name": "tag:Name", "Values": [name]}])
-        )
+        vpcs = self._resolver.resolve_one("vpcs", name)
 
         if len(vpcs) == 0:
             raise SkipResource("The vpc for this security group is not available.")
@@ -1783,61 +3523,142 @@ class SecurityGroupHandler(AWSHandler):
         elif len(vpcs) > 1:
             raise SkipResource("Multiple VPCs with the same name tag found.")
 
-        return vpcs[0]
+        return self._ec2.Vpc(vpcs[0])
 
-    def _build_rule_arg(self, add_rule):
-        proto = add_rule["protocol"]
-        rule = {
-            "FromPort": add_rule["port_range_min"],
-            "ToPort": add_rule["port_range_max"],
-            "IpProtocol": proto if proto != "all" else "-1",
-        }
-        if "remote_ip_prefix" in add_rule:
-            rule["IpRanges"] = [{"CidrIp": add_rule["remote_ip_prefix"]}]
+    def _build_permissions(self, rules, group_ids):
+        """
+        Build the IpPermissions argument for a list of rules. Rules with the same protocol and port range are
+        merged into one permission. group_ids maps the names of the groups in the vpc to their id.
+        """
+        permissions = {}
+        for rule in rules:
+            _, protocol, port_min, port_max, remote_ip_prefix, remote_group = rule_key(
+                rule
+            )
+            permission = permissions.setdefault(
+                (protocol, port_min, port_max),
+                {
+                    "FromPort": port_min,
+                    "ToPort": port_max,
+                    "IpProtocol": protocol if protocol != "all" else "-1",
+                },
+            )
+            if remote_ip_prefix is not None:
+                permission.setdefault("IpRanges", []).append(
+                    {"CidrIp": remote_ip_prefix}
+                )
 
-        elif "remote_group" in add_rule:
-            raise Exception("Todo!!")
+            elif remote_group is not None:
+                permission.setdefault("UserIdGroupPairs", []).append(
+                    {"GroupId": group_ids.get(remote_group, remote_group)}
+                )
 
-        return rule
+        return list(permissions.values())
 
-    def _update_rules(self, ctx, group, resource, current_rules, desired_rules):
+    def _apply_rules(self, rules, operation, build_args):
+        """
+        Authorize or revoke rules in as few calls as possible and return the rules that failed with their error.
+        build_args returns the arguments of operation for a list of rules. A call fails as a whole when one of its
+        rules fails, the rules of a failed call are retried one by one to find the rules that fail.
+        """
+        failed = []
+        for i in range(0, len(rules), MAX_RULES_PER_CALL):
+            chunk = rules[i : i + MAX_RULES_PER_CALL]
+            try:
+                operation(**build_args(chunk))
+            except botocore.exceptions.ClientError as e:
+                if len(chunk) == 1:
+                    failed.append((chunk[0], e))
+                    continue
+
+                for rule in chunk:
+                    try:
+                        operation(**build_args([rule]))
+                    except botocore.exceptions.ClientError as e:
+                        failed.append((rule, e))
+        return failed
+
+    def _update_rules(
+        self, ctx, group, resource, current_rules, desired_rules, group_ids
+    ):
         """
         Update the rules to the desired state
         """
-        remove_rules = list(current_rules)
-        add_rules = list(desired_rules)
+        add_rules, remove_rules = diff_rules(current_rules, desired_rules)
 
-        for new_rule in desired_rules:
-            for old_rule in current_rules:
-                if self._compare_rule(old_rule, new_rule):
-                    remove_rules.remove(old_rule)
-                    add_rules.remove(new_rule)
-                    break
+        def is_unknown_group(rule):
+            return "remote_group" in rule and rule["remote_group"] not in group_ids
 
-        for add_rule in add_rules:
-            rule = self._build_rule_arg(add_rule)
-            if add_rule["direction"] == "ingress":
-                group.authorize_ingress(IpPermissions=[rule])
-            else:
-                group.authorize_egress(IpPermissions=[rule])
+        failed = [rule for rule in add_rules if is_unknown_group(rule)]
+        add_rules = [rule for rule in add_rules if not is_unknown_group(rule)]
+        for rule in failed:
+            ctx.error(
+                "Failed to add rule %(rule)s: security group %(group)s not found in the vpc",
+                rule=rule,
+                group=rule["remote_group"],
+            )
 
-        for remove_rule in remove_rules:
-            rule = self._build_rule_arg(remove_rule)
-            if remove_rule["direction"] == "ingress":
-                group.revoke_ingress(IpPermissions=[rule])
-            else:
-                group.revoke_egress(IpPermissions=[rule])
+        def by_permission(rules):
+            return {"IpPermissions": self._build_permissions(rules, group_ids)}
+
+        def by_id(rules):
+            return {"SecurityGroupRuleIds": [rule["rule_id"] for rule in rules]}
+
+        for direction, authorize, revoke in (
+            ("ingress", group.authorize_ingress, group.revoke_ingress),
+            ("egress", group.authorize_egress, group.revoke_egress),
+        ):
+            rules = [rule for rule in add_rules if rule["direction"] == direction]
+            calls = [("add", rules, authorize, by_permission)]
+            # Rules that were read from EC2 are revoked by their id
+            rules = [rule for rule in remove_rules if rule["direction"] == direction]
+            calls.append(
+                ("remove", [r for r in rules if "rule_id" in r], revoke, by_id)
+            )
+            calls.append(
+                (
+                    "remove",
+                    [r for r in rules if "rule_id" not in r],
+                    revoke,
+                    by_permission,
+                )
+            )
+
+            for action, rules, operation, build_args in calls:
+                for rule, error in self._apply_rules(rules, operation, build_args):
+                    ctx.error(
+                        "Failed to %(action)s rule %(rule)s: %(error)s",
+                        action=action,
+                        rule=rule,
+                        error=str(error),
+                    )
+                    failed.append(rule)
+
+        if failed:
+            raise Exception(
+                f"Failed to update {len(failed)} rules of security group {group.id}"
+            )
 
     def create_resource(self, ctx: HandlerContext, resource: SecurityGroup) -> None:
         vpc = ctx.get("vpc")
         sg = vpc.create_security_group(
             GroupName=resource.name, Description=resource.description, VpcId=vpc.id
         )
-        client = self._session.client("ec2")
-        waiter = client.get_waiter("security_group_exists")
-        waiter.wait(GroupIds=[sg.id])
-        current_rules = self._build_current_rules(ctx, sg)
-        self._update_rules(ctx, sg, resource, current_rules, resource.rules)
+        self._poller.wait(
+            Waiter.for_operation(resource, "security_group"),
+            "security_groups",
+            "group-id",
+            sg.id,
+            lambda groups: len(groups) > 0,
+            ctx,
+        )
+        group_ids = dict(ctx.get("group_ids"))
+        group_ids[resource.name] = sg.id
+        current_rules = self._build_current_rules(
+            ctx, sg, {group_id: name for name, group_id in group_ids.items()}
+        )
+        self._update_rules(ctx, sg, resource, current_rules, resource.rules, group_ids)
+        self._invalidate("security_groups", name=resource.name, object_id=sg.id)
         ctx.set_created()
 
     def update_resource(
@@ -1850,9 +3671,13 @@ class SecurityGroupHandler(AWSHandler):
                 resource,
                 changes["rules"]["current"],
                 changes["rules"]["desired"],
+                ctx.get("group_ids"),
             )
+            self._invalidate("security_groups", object_id=ctx.get("sg").id)
         ctx.set_updated()
 
     def delete_resource(self, ctx: HandlerContext, resource: SecurityGroup) -> None:
-        ctx.get("sg").delete()
+        sg = ctx.get("sg")
+        sg.delete()
+        self._invalidate("security_groups", name=resource.name, object_id=sg.id)
         ctx.set_purged()
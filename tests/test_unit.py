@@ -0,0 +1,1460 @@
+"""
+    Copyright 2017 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import logging
+import threading
+import time
+
+import botocore
+import pytest
+from botocore.stub import Stubber
+from inmanta.agent.handler import HandlerContext, SkipResource
+from inmanta.const import LogLevel
+from inmanta.resources import Resource, resource
+
+from inmanta_plugins.aws import (
+    ClientPool,
+    DatabaseIndex,
+    EC2Inventory,
+    ElasticSearchHandler,
+    ElasticSearchIndex,
+    ImageCache,
+    InstanceLauncher,
+    InstanceTerminator,
+    InternetGatewayHandler,
+    LoadBalancerIndex,
+    NameResolver,
+    RouteHandler,
+    RouteReconciler,
+    SecurityGroupHandler,
+    StatePoller,
+    SubnetHandler,
+    VirtualMachineHandler,
+    VPCHandler,
+    VpcNetworkIndex,
+    Waiter,
+    WaitTimeout,
+    diff_rules,
+    key_fingerprint,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    """
+    The tests in this module stub the AWS API, so there is nothing to clean up in the account.
+    """
+    yield
+
+
+class Agent:
+    eventloop = None
+
+
+def get_handler(handler_class, entity, access_key, **attributes):
+    """
+    Build a handler and a resource of the given entity and run the pre step of the handler. Every test uses its own
+    access key, so it gets its own shared caches.
+    """
+    resource_class, options = resource.get_class(entity)
+    fields = {field: None for field in resource_class.fields}
+    fields.update(
+        requires=[],
+        purged=False,
+        purge_on_delete=False,
+        managed=True,
+        send_event=False,
+        receive_events=False,
+        provider={
+            "name": "test",
+            "region": "eu-west-1",
+            "access_key": access_key,
+            "secret_key": "secret",
+            "cache_ttl": 30,
+            "waiters": {},
+            "log_api_responses": False,
+        },
+    )
+    fields.update(attributes)
+    id_attribute = options["name"]
+    fields["id"] = f"{entity}[test,{id_attribute}={fields[id_attribute]}],v=1"
+    aws_resource = Resource.deserialize(fields)
+    ctx = HandlerContext(aws_resource)
+    handler = handler_class(Agent())
+    handler.pre(ctx, aws_resource)
+    return handler, ctx, aws_resource
+
+
+def test_client_pool():
+    """
+    Clients are shared per (region, access key, service) and re-created when the secret key changes.
+    """
+    pool = ClientPool()
+
+    client = pool.get_client("eu-west-1", "access", "secret", "ec2")
+    assert pool.get_client("eu-west-1", "access", "secret", "ec2") is client
+    assert pool.get_client("eu-west-1", "access", "secret", "elb") is not client
+
+    resource = pool.get_resource("eu-west-1", "access", "secret", "ec2")
+    assert pool.get_resource("eu-west-1", "access", "secret", "ec2") is resource
+    assert pool.stats() == {"hits": 2, "misses": 3, "renewals": 0}
+
+    assert pool.get_client("eu-west-1", "access", "other", "ec2") is not client
+    assert pool.get_resource("eu-west-1", "access", "other", "ec2") is not resource
+    assert pool.stats() == {"hits": 2, "misses": 5, "renewals": 1}
+
+
+def test_ec2_inventory():
+    """
+    The inventory fetches all registered names in one batch and only refreshes the names that were marked stale.
+    """
+    inventory = EC2Inventory.for_provider(("eu-west-1", "inventory", "secret"), 30)
+    client = inventory.get_client("ec2")
+
+    def instances(*names):
+        return {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {
+                            "InstanceId": f"i-{name}",
+                            "Tags": [{"Key": "Name", "Value": name}],
+                            "State": {"Name": "running"},
+                        }
+                        for name in names
+                    ]
+                }
+            ]
+        }
+
+    def name_filter(*names):
+        return {"Filters": [{"Name": "tag:Name", "Values": list(names)}]}
+
+    inventory.register("instances", "vm1")
+    inventory.register("instances", "vm2")
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_instances", instances("vm1", "vm2"), name_filter("vm1", "vm2")
+        )
+        stubber.add_response("describe_instances", instances(), name_filter("vm3"))
+        stubber.add_response("describe_instances", instances("vm1"), name_filter("vm1"))
+        stubber.add_response("describe_instances", instances("vm1", "vm2", "vm4"), {})
+
+        assert [x["InstanceId"] for x in inventory.get("instances", "vm1")] == ["i-vm1"]
+        assert [x["InstanceId"] for x in inventory.get("instances", "vm2")] == ["i-vm2"]
+        assert inventory.get("instances", "vm3") == []
+
+        inventory.invalidate("instances", name="vm1")
+        assert [x["InstanceId"] for x in inventory.get("instances", "vm1")] == ["i-vm1"]
+
+        # Listing all instances takes a snapshot of the whole region
+        assert len(inventory.all("instances")) == 3
+        assert [x["InstanceId"] for x in inventory.get("instances", "vm4")] == ["i-vm4"]
+        stubber.assert_no_pending_responses()
+
+
+def test_name_resolver():
+    """
+    Names are resolved together and cached, including the names that do not exist. Security groups are cached per
+    vpc, entries expire after the ttl and the least recently used entries are evicted.
+    """
+    resolver = NameResolver.for_provider(("eu-west-1", "resolver", "secret"), 30)
+    client = resolver.get_client("ec2")
+
+    def vpcs(*names):
+        return {
+            "Vpcs": [
+                {"VpcId": f"vpc-{name}", "Tags": [{"Key": "Name", "Value": name}]}
+                for name in names
+            ]
+        }
+
+    def name_filter(*names):
+        return {"Filters": [{"Name": "tag:Name", "Values": list(names)}]}
+
+    def group_filter(name, vpc_id):
+        return {
+            "Filters": [
+                {"Name": "group-name", "Values": [name]},
+                {"Name": "vpc-id", "Values": [vpc_id]},
+            ]
+        }
+
+    def groups(name, group_id):
+        return {"SecurityGroups": [{"GroupId": group_id, "GroupName": name}]}
+
+    with Stubber(client) as stubber:
+        stubber.add_response("describe_vpcs", vpcs("a"), name_filter("a", "b"))
+        stubber.add_response(
+            "describe_security_groups",
+            groups("web", "sg-1"),
+            group_filter("web", "vpc-a"),
+        )
+        stubber.add_response(
+            "describe_security_groups",
+            groups("web", "sg-2"),
+            group_filter("web", "vpc-b"),
+        )
+        stubber.add_response("describe_vpcs", vpcs("a"), name_filter("a"))
+
+        assert resolver.resolve("vpcs", ["b", "a"]) == {"a": ["vpc-a"], "b": []}
+        assert resolver.resolve_one("vpcs", "b") == []
+        assert resolver.name_of("vpcs", "vpc-a") == "a"
+
+        assert resolver.resolve_one("security_groups", "web", "vpc-a") == ["sg-1"]
+        assert resolver.resolve_one("security_groups", "web", "vpc-b") == ["sg-2"]
+        assert resolver.resolve_one("security_groups", "web", "vpc-a") == ["sg-1"]
+
+        resolver.invalidate("vpcs", name="a")
+        assert resolver.resolve_one("vpcs", "a") == ["vpc-a"]
+        stubber.assert_no_pending_responses()
+
+    resolver = NameResolver.for_provider(("eu-west-1", "resolver-lru", "secret"), 0.2)
+    resolver.MAX_ENTRIES = 2
+    client = resolver.get_client("ec2")
+    with Stubber(client) as stubber:
+        for name in ("x1", "x2", "x3", "x2", "x1"):
+            stubber.add_response("describe_vpcs", vpcs(), name_filter(name))
+
+        resolver.resolve_one("vpcs", "x1")
+        resolver.resolve_one("vpcs", "x2")
+        resolver.resolve_one("vpcs", "x1")
+        # x2 is the least recently used entry
+        resolver.resolve_one("vpcs", "x3")
+        resolver.resolve_one("vpcs", "x1")
+        resolver.resolve_one("vpcs", "x2")
+
+        time.sleep(0.3)
+        resolver.resolve_one("vpcs", "x1")
+        stubber.assert_no_pending_responses()
+
+
+def test_waiter():
+    """
+    The waiter retries with a growing delay and gives up after max_attempts.
+    """
+    waiter = Waiter(
+        "test", timeout=10, max_attempts=4, initial_delay=0.01, max_delay=0.02
+    )
+
+    results = iter([False, False, "done"])
+    assert waiter.until(lambda: next(results)) == "done"
+
+    calls = []
+    with pytest.raises(WaitTimeout):
+        waiter.until(lambda: calls.append(1))
+    assert len(calls) == 4
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        waiter.call(fail, retry_on=(ValueError,))
+
+
+def test_instance_terminator():
+    """
+    Concurrent terminations share one terminate_instances call.
+    """
+    terminator = InstanceTerminator.for_provider(
+        ("eu-west-1", "terminator", "secret"), 30
+    )
+    client = terminator.get_client("ec2")
+
+    def state(instance_id, name):
+        return {
+            "InstanceId": instance_id,
+            "CurrentState": {"Name": name},
+            "PreviousState": {"Name": "running"},
+        }
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "terminate_instances",
+            {
+                "TerminatingInstances": [
+                    state("i-1", "shutting-down"),
+                    state("i-2", "shutting-down"),
+                ]
+            },
+        )
+        results = {}
+        threads = [
+            threading.Thread(
+                target=lambda x=x: results.__setitem__(x, terminator.terminate(x))
+            )
+            for x in ("i-1", "i-2")
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == {"i-1": "shutting-down", "i-2": "shutting-down"}
+        stubber.assert_no_pending_responses()
+
+
+def test_state_poller():
+    """
+    All objects that are waited for are polled in one describe call and every wait gets its own objects.
+    """
+
+    class FastPoller(StatePoller):
+        POLL_INTERVAL = 0.2
+
+    poller = FastPoller.for_provider(("eu-west-1", "poller", "secret"), 30)
+    client = poller.get_client("ec2")
+    waiter = Waiter("test", timeout=10, max_attempts=2, initial_delay=0, max_delay=0)
+
+    def instances(**states):
+        return {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {"InstanceId": instance_id, "State": {"Name": state}}
+                        for instance_id, state in states.items()
+                    ]
+                }
+            ]
+        }
+
+    def terminated(instances):
+        return all(x["State"]["Name"] == "terminated" for x in instances)
+
+    with Stubber(client) as stubber:
+        filters = {"Filters": [{"Name": "instance-id", "Values": ["i-1", "i-2"]}]}
+        stubber.add_response(
+            "describe_instances",
+            instances(**{"i-1": "terminated", "i-2": "shutting-down"}),
+            filters,
+        )
+        stubber.add_response(
+            "describe_instances",
+            instances(**{"i-2": "shutting-down"}),
+            {"Filters": [{"Name": "instance-id", "Values": ["i-2"]}]},
+        )
+
+        results = {}
+        errors = {}
+
+        def wait(instance_id):
+            try:
+                results[instance_id] = poller.wait(
+                    waiter, "instances", "instance-id", instance_id, terminated
+                )
+            except WaitTimeout as e:
+                errors[instance_id] = e
+
+        # Both waits are registered well before the first poll
+        threads = [threading.Thread(target=wait, args=(x,)) for x in ("i-1", "i-2")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert [x["InstanceId"] for x in results["i-1"]] == ["i-1"]
+        assert list(errors) == ["i-2"]
+        stubber.assert_no_pending_responses()
+
+
+def test_state_poller_failing_condition():
+    """
+    An exception in the condition of a wait is raised in that wait and the poller keeps serving later waits.
+    """
+
+    class FastPoller(StatePoller):
+        POLL_INTERVAL = 0.2
+
+    poller = FastPoller.for_provider(("eu-west-1", "poller-error", "secret"), 30)
+    client = poller.get_client("ec2")
+    waiter = Waiter("test", timeout=10, max_attempts=2, initial_delay=0, max_delay=0)
+    response = {
+        "Reservations": [
+            {"Instances": [{"InstanceId": "i-1", "State": {"Name": "running"}}]}
+        ]
+    }
+    filters = {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}]}
+
+    def broken(instances):
+        return instances[0]["Missing"]
+
+    with Stubber(client) as stubber:
+        stubber.add_response("describe_instances", response, filters)
+        stubber.add_response("describe_instances", response, filters)
+
+        with pytest.raises(KeyError):
+            poller.wait(waiter, "instances", "instance-id", "i-1", broken)
+
+        items = poller.wait(waiter, "instances", "instance-id", "i-1", lambda x: True)
+        assert [x["InstanceId"] for x in items] == ["i-1"]
+        stubber.assert_no_pending_responses()
+
+
+def test_state_poller_restart():
+    """
+    A wait that registers while the poller thread is stopping gets a new poller thread.
+    """
+
+    class FastPoller(StatePoller):
+        POLL_INTERVAL = 0.1
+
+    poller = FastPoller.for_provider(("eu-west-1", "poller-restart", "secret"), 30)
+    client = poller.get_client("ec2")
+    waiter = Waiter("test", timeout=5, max_attempts=2, initial_delay=0, max_delay=0)
+    response = {
+        "Reservations": [
+            {"Instances": [{"InstanceId": "i-1", "State": {"Name": "running"}}]}
+        ]
+    }
+    filters = {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}]}
+    results = []
+
+    def second_wait():
+        results.append(
+            poller.wait(waiter, "instances", "instance-id", "i-1", lambda x: True)
+        )
+
+    class Lock:
+        """
+        A lock that registers a second wait right after the poller thread released the lock for the third time:
+        after it read the waits, after it polled them and after it found that nobody is waiting anymore.
+        """
+
+        def __init__(self):
+            self._lock = threading.Lock()
+            self._releases = 0
+            self.thread = None
+
+        def __enter__(self):
+            self._lock.acquire()
+
+        def __exit__(self, *exc_info):
+            self._lock.release()
+            if threading.current_thread().name != "aws-state-poller":
+                return
+            self._releases += 1
+            if self._releases == 3:
+                self.thread = threading.Thread(target=second_wait)
+                self.thread.start()
+                # Give the second wait the time to register before this thread continues
+                time.sleep(0.3)
+
+    poller._lock = Lock()
+    with Stubber(client) as stubber:
+        stubber.add_response("describe_instances", response, filters)
+        stubber.add_response("describe_instances", response, filters)
+
+        poller.wait(waiter, "instances", "instance-id", "i-1", lambda x: True)
+        time.sleep(0.5)
+        poller._lock.thread.join()
+
+        assert [x["InstanceId"] for x in results[0]] == ["i-1"]
+        stubber.assert_no_pending_responses()
+
+
+def test_state_poller_timeout():
+    """
+    A wait that times out is no longer polled.
+    """
+    poller = StatePoller.for_provider(("eu-west-1", "poller-timeout", "secret"), 30)
+    waiter = Waiter("test", timeout=0.1, max_attempts=2, initial_delay=0, max_delay=0)
+
+    with pytest.raises(WaitTimeout):
+        poller.wait(waiter, "instances", "instance-id", "i-1", lambda x: True)
+    assert poller._waits == {}
+
+
+def test_vm_termination_without_wait():
+    """
+    Without wait_for_termination the delete terminates the instance and skips the resource. An instance that is
+    shutting down is not terminated again and is skipped until it is terminated.
+    """
+    handler, ctx, vm = get_handler(
+        VirtualMachineHandler,
+        "aws::VirtualMachine",
+        "vm-terminate",
+        name="vm",
+        key_name="key",
+        key_value="",
+        wait_for_termination=False,
+    )
+    client = handler._get_aws_client("ec2")
+
+    def instance(state):
+        return {
+            "InstanceId": "i-1",
+            "State": {"Name": state},
+            "Tags": [{"Key": "Name", "Value": "vm"}],
+        }
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "terminate_instances",
+            {
+                "TerminatingInstances": [
+                    {
+                        "InstanceId": "i-1",
+                        "CurrentState": {"Name": "shutting-down"},
+                        "PreviousState": {"Name": "running"},
+                    }
+                ]
+            },
+            {"InstanceIds": ["i-1"]},
+        )
+        ctx.set("instance", handler._ec2_object("Instance", "i-1", instance("running")))
+        with pytest.raises(SkipResource):
+            handler.delete_resource(ctx, vm)
+        stubber.assert_no_pending_responses()
+
+        # An instance that is shutting down is not terminated a second time
+        ctx.set(
+            "instance",
+            handler._ec2_object("Instance", "i-1", instance("shutting-down")),
+        )
+        with pytest.raises(SkipResource):
+            handler.delete_resource(ctx, vm)
+
+        stubber.add_response("describe_key_pairs", {"KeyPairs": []})
+        stubber.add_response(
+            "describe_instances",
+            {"Reservations": [{"Instances": [instance("shutting-down")]}]},
+            {"Filters": [{"Name": "tag:Name", "Values": ["vm"]}]},
+        )
+        # The instance is shutting down, but the model still wants it
+        with pytest.raises(SkipResource):
+            handler.read_resource(ctx, vm)
+
+        vm.purged = True
+        handler.read_resource(ctx, vm)
+        assert not vm.purged
+        stubber.assert_no_pending_responses()
+
+
+def test_wait_until_attachable():
+    """
+    A new virtual machine waits on the shared poller until it is running and its volumes are created.
+    """
+    handler, ctx, vm = get_handler(
+        VirtualMachineHandler,
+        "aws::VirtualMachine",
+        "attach",
+        name="vm",
+        volumes=["vol1", "vol2"],
+    )
+    handler._poller.POLL_INTERVAL = 0.1
+    client = handler._get_aws_client("ec2")
+
+    def instances(state):
+        return {
+            "Reservations": [
+                {"Instances": [{"InstanceId": "i-1", "State": {"Name": state}}]}
+            ]
+        }
+
+    def volumes(*states):
+        return {
+            "Volumes": [
+                {
+                    "VolumeId": f"vol-{i}",
+                    "State": state,
+                    "Tags": [{"Key": "Name", "Value": f"vol{i}"}],
+                }
+                for i, state in enumerate(states, start=1)
+            ]
+        }
+
+    instance_filter = {"Filters": [{"Name": "instance-id", "Values": ["i-1"]}]}
+    volume_filter = {"Filters": [{"Name": "tag:Name", "Values": ["vol1", "vol2"]}]}
+
+    with Stubber(client) as stubber:
+        # All waits are served by one describe call per kind
+        stubber.add_response(
+            "describe_instances", instances("pending"), instance_filter
+        )
+        stubber.add_response(
+            "describe_volumes", volumes("creating", "available"), volume_filter
+        )
+        stubber.add_response(
+            "describe_instances", instances("running"), instance_filter
+        )
+        stubber.add_response(
+            "describe_volumes",
+            volumes("available"),
+            {"Filters": [{"Name": "tag:Name", "Values": ["vol1"]}]},
+        )
+
+        instance = handler._ec2_object(
+            "Instance", "i-1", {"InstanceId": "i-1", "State": {"Name": "pending"}}
+        )
+        instance = handler._wait_until_attachable(ctx, vm, instance, ["vol1", "vol2"])
+        assert instance.state["Name"] == "running"
+        stubber.assert_no_pending_responses()
+
+    vm.provider["waiters"] = {"instance_running": {"max_attempts": 1}}
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_instances", instances("pending"), instance_filter
+        )
+        with pytest.raises(SkipResource):
+            handler._wait_until_attachable(ctx, vm, instance, [])
+
+
+def test_image_cache():
+    """
+    An image is described once and every caller gets its own copy of the metadata.
+    """
+    images = ImageCache.for_provider(("eu-west-1", "images", "secret"), 30)
+    client = images.get_client("ec2")
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_images",
+            {
+                "Images": [
+                    {
+                        "ImageId": "ami-1",
+                        "BlockDeviceMappings": [
+                            {"DeviceName": "/dev/xvda", "Ebs": {"VolumeSize": 8}}
+                        ],
+                    }
+                ]
+            },
+            {"ImageIds": ["ami-1"]},
+        )
+
+        image = images.get("ami-1")
+        image["BlockDeviceMappings"][0]["Ebs"]["VolumeSize"] = 16
+        assert images.get("ami-1")["BlockDeviceMappings"][0]["Ebs"]["VolumeSize"] == 8
+        stubber.assert_no_pending_responses()
+
+
+def test_instance_launcher():
+    """
+    Concurrent launches with the same parameters share one run_instances call and each instance gets its name.
+    """
+    launcher = InstanceLauncher.for_provider(("eu-west-1", "launcher", "secret"), 30)
+    client = launcher.get_client("ec2")
+    args = {"ImageId": "ami-1", "InstanceType": "t2.micro", "SubnetId": "subnet-1"}
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "run_instances",
+            {"Instances": [{"InstanceId": "i-1"}, {"InstanceId": "i-2"}]},
+            dict(args, MinCount=1, MaxCount=2),
+        )
+        stubber.add_response(
+            "create_tags",
+            {},
+            {"Resources": ["i-1"], "Tags": [{"Key": "Name", "Value": "vm1"}]},
+        )
+        stubber.add_response(
+            "create_tags",
+            {},
+            {"Resources": ["i-2"], "Tags": [{"Key": "Name", "Value": "vm2"}]},
+        )
+
+        results = {}
+        threads = []
+        for name in ("vm1", "vm2"):
+            threads.append(
+                threading.Thread(
+                    target=lambda x=name: results.__setitem__(
+                        x, launcher.launch(args, x)["InstanceId"]
+                    )
+                )
+            )
+            threads[-1].start()
+            # Keep the order of the launches
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+
+        assert results == {"vm1": "i-1", "vm2": "i-2"}
+        stubber.assert_no_pending_responses()
+
+    # The batch is dropped once it is launched
+    assert launcher._batches == {}
+
+
+def test_key_fingerprint():
+    """
+    The fingerprint of a public key matches the one EC2 reports for the imported key.
+    """
+    rsa = (
+        "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQDqDC9cZCUj5JyPazyHd+qsiOw8Myyb2hPlz/OQchf7cVHcAf0r522Qm/pWhF0nGmpfovuAbc5H0"
+        "tbESJjCrpoeg61q3Ykmok7ioC960G3U1zZrgWylUn+9aLpTEljTHm51FdZL2M0816oC/sXpZIf5JQQpjRjP3DJuMDFpUgSY9w== test"
+    )
+    assert key_fingerprint(rsa) == "4e:da:9d:75:1f:03:bd:b7:f3:a0:33:a1:8e:2c:0a:8e"
+
+    ed25519 = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIOWtnRAcHIicq3StUmeEzsxwkqeMkNg5JfWzc25q5oTT test"
+    assert key_fingerprint(ed25519) == "FIBbv6jJ1dNwNo8Hbvh3O6dVfE7EZWTcsbRft93we8I"
+
+    assert key_fingerprint("not a key") is None
+
+
+def test_security_group_rule_diff():
+    """
+    Rules are matched on their canonical form: ports 0 and -1 are equal, except for icmp, and ports are ignored
+    for all protocols.
+    """
+    current = [
+        {
+            "protocol": "tcp",
+            "direction": "ingress",
+            "port_range_min": 22,
+            "port_range_max": 22,
+            "remote_ip_prefix": "0.0.0.0/0",
+        },
+        {
+            "protocol": "all",
+            "direction": "egress",
+            "port_range_min": -1,
+            "port_range_max": -1,
+            "remote_ip_prefix": "0.0.0.0/0",
+        },
+        {
+            "protocol": "udp",
+            "direction": "ingress",
+            "port_range_min": 53,
+            "port_range_max": 53,
+            "remote_ip_prefix": "10.0.0.0/8",
+        },
+    ]
+    desired = [
+        {
+            "protocol": "all",
+            "direction": "egress",
+            "port_range_min": 0,
+            "port_range_max": 0,
+            "remote_ip_prefix": "0.0.0.0/0",
+        },
+        {
+            "protocol": "tcp",
+            "direction": "ingress",
+            "port_range_min": 22,
+            "port_range_max": 22,
+            "remote_ip_prefix": "0.0.0.0/0",
+        },
+        {
+            "protocol": "tcp",
+            "direction": "ingress",
+            "port_range_min": 80,
+            "port_range_max": 80,
+            "remote_ip_prefix": "0.0.0.0/0",
+        },
+    ]
+
+    add, remove = diff_rules(current, desired)
+    assert add == [desired[2]]
+    assert remove == [current[2]]
+    assert diff_rules(current, current) == ([], [])
+
+    # An icmp echo reply rule is not the same as a rule for all icmp types
+    echo_reply = dict(current[2], protocol="icmp", port_range_min=0, port_range_max=-1)
+    all_icmp = dict(echo_reply, port_range_min=-1)
+    assert diff_rules([echo_reply], [all_icmp]) == ([all_icmp], [echo_reply])
+
+
+@pytest.mark.parametrize("size", [1000, 5000])
+def test_security_group_rule_diff_benchmark(size):
+    """
+    Microbenchmark of the rule diff of large security groups. Half of the rules differ.
+    """
+
+    def rules(offset):
+        return [
+            {
+                "protocol": "tcp",
+                "direction": "ingress",
+                "port_range_min": 443,
+                "port_range_max": 443,
+                "remote_ip_prefix": f"10.{i // 256 % 256}.{i % 256}.0/24",
+            }
+            for i in range(offset, offset + size)
+        ]
+
+    current = rules(0)
+    desired = rules(size // 2)
+
+    start = time.perf_counter()
+    add, remove = diff_rules(current, desired)
+    duration = time.perf_counter() - start
+    LOGGER.info("Diff of %d rules took %.2fms", size, duration * 1000)
+
+    assert len(add) == len(remove) == size // 2
+    assert duration < 1
+
+
+def security_group_rule(rule_id, **rule):
+    rule.setdefault("IsEgress", False)
+    rule.setdefault("IpProtocol", "tcp")
+    return {"SecurityGroupRuleId": rule_id, "GroupId": "sg-1", **rule}
+
+
+def test_security_group_read():
+    """
+    The rules of a security group are read with their id and groups of the vpc are resolved to their name. Rules
+    the model can not express are ignored without an error.
+    """
+    handler, ctx, group = get_handler(
+        SecurityGroupHandler,
+        "aws::SecurityGroup",
+        "sg-read",
+        name="web",
+        vpc="vpc",
+        description="",
+        rules=[],
+    )
+    client = handler._get_aws_client("ec2")
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_vpcs",
+            {"Vpcs": [{"VpcId": "vpc-1", "Tags": [{"Key": "Name", "Value": "vpc"}]}]},
+        )
+        stubber.add_response(
+            "describe_security_groups",
+            {
+                "SecurityGroups": [
+                    {
+                        "GroupId": f"sg-{i}",
+                        "GroupName": name,
+                        "VpcId": "vpc-1",
+                        "Description": "",
+                    }
+                    for i, name in ((1, "web"), (2, "db"))
+                ]
+            },
+            {"Filters": [{"Name": "vpc-id", "Values": ["vpc-1"]}]},
+        )
+        stubber.add_response(
+            "describe_security_group_rules",
+            {
+                "SecurityGroupRules": [
+                    security_group_rule(
+                        "sgr-1", FromPort=22, ToPort=22, CidrIpv4="0.0.0.0/0"
+                    ),
+                    security_group_rule(
+                        "sgr-2",
+                        FromPort=5432,
+                        ToPort=5432,
+                        ReferencedGroupInfo={"GroupId": "sg-2"},
+                    ),
+                    security_group_rule(
+                        "sgr-3",
+                        FromPort=80,
+                        ToPort=80,
+                        ReferencedGroupInfo={"GroupId": "sg-9"},
+                    ),
+                    security_group_rule(
+                        "sgr-4", IsEgress=True, IpProtocol="-1", CidrIpv6="::/0"
+                    ),
+                    security_group_rule("sgr-5", PrefixListId="pl-1"),
+                ]
+            },
+            {"Filters": [{"Name": "group-id", "Values": ["sg-1"]}]},
+        )
+
+        handler.read_resource(ctx, group)
+        stubber.assert_no_pending_responses()
+
+    def rule(rule_id, port, **remote):
+        return {
+            "rule_id": rule_id,
+            "direction": "ingress",
+            "protocol": "tcp",
+            "port_range_min": port,
+            "port_range_max": port,
+            **remote,
+        }
+
+    assert group.rules == [
+        rule("sgr-1", 22, remote_ip_prefix="0.0.0.0/0"),
+        rule("sgr-2", 5432, remote_group="db"),
+        # A group outside of the vpc keeps its id
+        rule("sgr-3", 80, remote_group="sg-9"),
+    ]
+    assert group.vpc == "vpc"
+    assert ctx.get("group_ids") == {"web": "sg-1", "db": "sg-2"}
+    assert not [log for log in ctx.logs if log.log_level == LogLevel.ERROR]
+
+
+def test_security_group_revoke_by_id():
+    """
+    Rules that were read from EC2 are revoked by their id, in one call per direction.
+    """
+    handler, ctx, group = get_handler(
+        SecurityGroupHandler, "aws::SecurityGroup", "sg-revoke", name="web", rules=[]
+    )
+    client = handler._ec2.meta.client
+    ctx.set("sg", handler._ec2_object("SecurityGroup", "sg-1", {"GroupId": "sg-1"}))
+    ctx.set("group_ids", {"web": "sg-1"})
+
+    def rule(rule_id, direction, port):
+        return {
+            "rule_id": rule_id,
+            "direction": direction,
+            "protocol": "tcp",
+            "port_range_min": port,
+            "port_range_max": port,
+            "remote_ip_prefix": "0.0.0.0/0",
+        }
+
+    current = [rule("sgr-1", "ingress", 22), rule("sgr-2", "ingress", 80)]
+    current.append(rule("sgr-3", "egress", 443))
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "revoke_security_group_ingress",
+            {"Return": True},
+            {"GroupId": "sg-1", "SecurityGroupRuleIds": ["sgr-1", "sgr-2"]},
+        )
+        stubber.add_response(
+            "revoke_security_group_egress",
+            {"Return": True},
+            {"GroupId": "sg-1", "SecurityGroupRuleIds": ["sgr-3"]},
+        )
+        handler.update_resource(
+            ctx, {"rules": {"current": current, "desired": []}}, group
+        )
+        stubber.assert_no_pending_responses()
+
+
+def test_security_group_authorize():
+    """
+    Rules with the same protocol and ports are authorized in one permission. When the batched call fails, the
+    rules are retried one by one and only the failing rule is reported.
+    """
+    handler, ctx, group = get_handler(
+        SecurityGroupHandler, "aws::SecurityGroup", "sg-authorize", name="web", rules=[]
+    )
+    client = handler._ec2.meta.client
+    ctx.set("sg", handler._ec2_object("SecurityGroup", "sg-1", {"GroupId": "sg-1"}))
+    ctx.set("group_ids", {"web": "sg-1"})
+
+    def rule(port, prefix):
+        return {
+            "direction": "ingress",
+            "protocol": "tcp",
+            "port_range_min": port,
+            "port_range_max": port,
+            "remote_ip_prefix": prefix,
+        }
+
+    def permission(port, *prefixes):
+        return {
+            "FromPort": port,
+            "ToPort": port,
+            "IpProtocol": "tcp",
+            "IpRanges": [{"CidrIp": prefix} for prefix in prefixes],
+        }
+
+    desired = [rule(22, "10.0.0.0/8"), rule(22, "192.168.0.0/16")]
+    desired.append(rule(80, "0.0.0.0/0"))
+
+    with Stubber(client) as stubber:
+        stubber.add_client_error(
+            "authorize_security_group_ingress",
+            service_error_code="InvalidPermission.Duplicate",
+            expected_params={
+                "GroupId": "sg-1",
+                "IpPermissions": [
+                    permission(22, "10.0.0.0/8", "192.168.0.0/16"),
+                    permission(80, "0.0.0.0/0"),
+                ],
+            },
+        )
+        stubber.add_response(
+            "authorize_security_group_ingress",
+            {"Return": True},
+            {"GroupId": "sg-1", "IpPermissions": [permission(22, "10.0.0.0/8")]},
+        )
+        stubber.add_client_error(
+            "authorize_security_group_ingress",
+            service_error_code="InvalidPermission.Duplicate",
+            expected_params={
+                "GroupId": "sg-1",
+                "IpPermissions": [permission(22, "192.168.0.0/16")],
+            },
+        )
+        stubber.add_response(
+            "authorize_security_group_ingress",
+            {"Return": True},
+            {"GroupId": "sg-1", "IpPermissions": [permission(80, "0.0.0.0/0")]},
+        )
+
+        with pytest.raises(Exception, match="Failed to update 1 rules"):
+            handler.update_resource(
+                ctx, {"rules": {"current": [], "desired": desired}}, group
+            )
+        stubber.assert_no_pending_responses()
+
+    errors = [log for log in ctx.logs if log.log_level == LogLevel.ERROR]
+    assert len(errors) == 1
+    assert "192.168.0.0/16" in errors[0].msg
+
+
+def test_security_group_remote_group():
+    """
+    The remote group of a rule is resolved to its id in the vpc. A rule with a group that is not in the vpc fails
+    without calling the API, the other rules are still added.
+    """
+    handler, ctx, group = get_handler(
+        SecurityGroupHandler, "aws::SecurityGroup", "sg-remote", name="web", rules=[]
+    )
+    client = handler._ec2.meta.client
+    ctx.set("sg", handler._ec2_object("SecurityGroup", "sg-1", {"GroupId": "sg-1"}))
+    ctx.set("group_ids", {"web": "sg-1", "db": "sg-2"})
+
+    def rule(remote_group):
+        return {
+            "direction": "egress",
+            "protocol": "tcp",
+            "port_range_min": 5432,
+            "port_range_max": 5432,
+            "remote_group": remote_group,
+        }
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "authorize_security_group_egress",
+            {"Return": True},
+            {
+                "GroupId": "sg-1",
+                "IpPermissions": [
+                    {
+                        "FromPort": 5432,
+                        "ToPort": 5432,
+                        "IpProtocol": "tcp",
+                        "UserIdGroupPairs": [{"GroupId": "sg-2"}],
+                    }
+                ],
+            },
+        )
+
+        with pytest.raises(Exception, match="Failed to update 1 rules"):
+            handler.update_resource(
+                ctx,
+                {"rules": {"current": [], "desired": [rule("db"), rule("missing")]}},
+                group,
+            )
+        stubber.assert_no_pending_responses()
+
+    errors = [log for log in ctx.logs if log.log_level == LogLevel.ERROR]
+    assert len(errors) == 1
+    assert "security group missing not found" in errors[0].msg
+
+
+def test_loadbalancer_index():
+    """
+    Registered loadbalancers are described together, a missing name falls back to listing all loadbalancers.
+    """
+    loadbalancers = LoadBalancerIndex.for_provider(("eu-west-1", "elb", "secret"), 30)
+    client = loadbalancers.get_client("elb")
+
+    def descriptions(*names):
+        return {
+            "LoadBalancerDescriptions": [
+                {"LoadBalancerName": name, "DNSName": f"{name}.example.com"}
+                for name in names
+            ]
+        }
+
+    loadbalancers.register("lb1")
+    loadbalancers.register("lb2")
+    loadbalancers.register("lb3")
+
+    with Stubber(client) as stubber:
+        stubber.add_client_error(
+            "describe_load_balancers",
+            service_error_code="LoadBalancerNotFound",
+            expected_params={"LoadBalancerNames": ["lb1", "lb2", "lb3"]},
+        )
+        stubber.add_response("describe_load_balancers", descriptions("lb1", "lb3"), {})
+
+        assert loadbalancers.get("lb1")["DNSName"] == "lb1.example.com"
+        assert loadbalancers.get("lb2") is None
+        assert loadbalancers.get("lb3")["DNSName"] == "lb3.example.com"
+        stubber.assert_no_pending_responses()
+
+
+def test_route_reconciler():
+    """
+    Route changes are applied against the indexed route table: a new target replaces the route in place.
+    """
+    credentials = ("eu-west-1", "routes", "secret")
+    network = VpcNetworkIndex.for_provider(credentials, 30)
+    routes = RouteReconciler.for_provider(credentials, 30)
+    client = routes.get_client("ec2")
+    route_table = {
+        "RouteTableId": "rtb-1",
+        "routes": {
+            "10.0.0.0/24": {
+                "DestinationCidrBlock": "10.0.0.0/24",
+                "NetworkInterfaceId": "eni-1",
+            }
+        },
+    }
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "replace_route",
+            {},
+            {
+                "RouteTableId": "rtb-1",
+                "DestinationCidrBlock": "10.0.0.0/24",
+                "NetworkInterfaceId": "eni-2",
+            },
+        )
+        stubber.add_response(
+            "create_route",
+            {"Return": True},
+            {
+                "RouteTableId": "rtb-1",
+                "DestinationCidrBlock": "10.1.0.0/24",
+                "NetworkInterfaceId": "eni-2",
+            },
+        )
+
+        def set_route(destination, eni_id):
+            return routes.set_route(network, "vpc-1", route_table, destination, eni_id)
+
+        assert set_route("10.0.0.0/24", "eni-2") == "replaced"
+        assert set_route("10.0.0.0/24", "eni-2") is None
+        assert set_route("10.1.0.0/24", "eni-2") == "created"
+        assert set_route("10.2.0.0/24", None) is None
+        stubber.assert_no_pending_responses()
+
+    assert route_table["routes"]["10.1.0.0/24"]["NetworkInterfaceId"] == "eni-2"
+
+
+def test_route_read_new_nexthop():
+    """
+    A nexthop that is not in the index of the vpc is looked up once more in a fresh index.
+    """
+    handler, ctx, route = get_handler(
+        RouteHandler,
+        "aws::Route",
+        "route-read",
+        destination="10.1.0.0/24",
+        nexthop="10.0.0.5",
+        vpc="vpc",
+    )
+    client = handler._get_aws_client("ec2")
+    vpc_filter = {"Filters": [{"Name": "vpc-id", "Values": ["vpc-1"]}]}
+    route_tables = {
+        "RouteTables": [
+            {
+                "RouteTableId": "rtb-1",
+                "Routes": [
+                    {
+                        "DestinationCidrBlock": "10.1.0.0/24",
+                        "NetworkInterfaceId": "eni-1",
+                    }
+                ],
+            }
+        ]
+    }
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_vpcs",
+            {"Vpcs": [{"VpcId": "vpc-1", "Tags": [{"Key": "Name", "Value": "vpc"}]}]},
+        )
+        stubber.add_response(
+            "describe_network_interfaces", {"NetworkInterfaces": []}, vpc_filter
+        )
+        stubber.add_response("describe_route_tables", route_tables, vpc_filter)
+        stubber.add_response(
+            "describe_network_interfaces",
+            {
+                "NetworkInterfaces": [
+                    {
+                        "NetworkInterfaceId": "eni-1",
+                        "PrivateIpAddresses": [{"PrivateIpAddress": "10.0.0.5"}],
+                    }
+                ]
+            },
+            vpc_filter,
+        )
+        stubber.add_response("describe_route_tables", route_tables, vpc_filter)
+
+        handler.read_resource(ctx, route)
+        stubber.assert_no_pending_responses()
+
+    assert route.nexthop == "10.0.0.5"
+    assert ctx.get("eni")["NetworkInterfaceId"] == "eni-1"
+
+
+def test_subnet_create_retry():
+    """
+    A subnet is tagged when it is created. A retry uses the subnet of an earlier attempt that was created after all.
+    """
+    handler, ctx, subnet = get_handler(
+        SubnetHandler,
+        "aws::Subnet",
+        "subnet-retry",
+        name="subnet",
+        vpc="vpc",
+        cidr_block="10.0.0.0/24",
+        availability_zone=None,
+        map_public_ip_on_launch=False,
+    )
+    subnet.provider["waiters"] = {"create_subnet": {"initial_delay": 0, "max_delay": 0}}
+    client = handler._get_aws_client("ec2")
+    resource_client = handler._ec2.meta.client
+    name_tag = [{"Key": "Name", "Value": "subnet"}]
+
+    with Stubber(client) as stubber, Stubber(resource_client) as resource_stubber:
+        stubber.add_response(
+            "describe_vpcs",
+            {"Vpcs": [{"VpcId": "vpc-1", "Tags": [{"Key": "Name", "Value": "vpc"}]}]},
+        )
+        resource_stubber.add_client_error(
+            "create_subnet",
+            service_error_code="RequestLimitExceeded",
+            expected_params={
+                "VpcId": "vpc-1",
+                "CidrBlock": "10.0.0.0/24",
+                "TagSpecifications": [{"ResourceType": "subnet", "Tags": name_tag}],
+            },
+        )
+        resource_stubber.add_response(
+            "describe_subnets",
+            {
+                "Subnets": [
+                    {
+                        "SubnetId": "subnet-1",
+                        "VpcId": "vpc-1",
+                        "CidrBlock": "10.0.0.0/24",
+                        "MapPublicIpOnLaunch": False,
+                        "Tags": name_tag,
+                    }
+                ]
+            },
+            {
+                "Filters": [
+                    {"Name": "tag:Name", "Values": ["subnet"]},
+                    {"Name": "vpc-id", "Values": ["vpc-1"]},
+                    {"Name": "cidr-block", "Values": ["10.0.0.0/24"]},
+                ]
+            },
+        )
+
+        handler.create_resource(ctx, subnet)
+        stubber.assert_no_pending_responses()
+        resource_stubber.assert_no_pending_responses()
+
+
+def test_ensure_name_tag():
+    """
+    The Name tag is only added when the object was not tagged when it was created.
+    """
+    handler, ctx, vpc = get_handler(VPCHandler, "aws::VPC", "name-tag", name="vpc")
+    client = handler._ec2.meta.client
+
+    tagged = handler._ec2_object(
+        "Vpc", "vpc-1", {"VpcId": "vpc-1", "Tags": [{"Key": "Name", "Value": "vpc"}]}
+    )
+    untagged = handler._ec2_object("Vpc", "vpc-2", {"VpcId": "vpc-2", "Tags": []})
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "create_tags",
+            {},
+            {"Resources": ["vpc-2"], "Tags": [{"Key": "Name", "Value": "vpc"}]},
+        )
+        handler._ensure_name_tag(ctx, vpc, tagged, "VPC")
+        handler._ensure_name_tag(ctx, vpc, untagged, "VPC")
+        stubber.assert_no_pending_responses()
+
+
+def test_internet_gateway_default_routes(monkeypatch):
+    """
+    Only the route tables without a default route get one and a failing route table is reported on its own.
+    """
+    handler, ctx, igw = get_handler(
+        InternetGatewayHandler, "aws::InternetGateway", "igw-routes", name="igw"
+    )
+    client = handler._get_aws_client("ec2")
+
+    def route_table(table_id, *destinations):
+        return {
+            "RouteTableId": table_id,
+            "Routes": [{"DestinationCidrBlock": x} for x in destinations],
+        }
+
+    created = []
+
+    def create_route(**kwargs):
+        created.append(kwargs)
+        if kwargs["RouteTableId"] == "rtb-3":
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "RouteAlreadyExists", "Message": ""}}, "CreateRoute"
+            )
+        return {"Return": True}
+
+    monkeypatch.setattr(client, "create_route", create_route)
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_route_tables",
+            {
+                "RouteTables": [
+                    route_table("rtb-1", "10.0.0.0/16", "0.0.0.0/0"),
+                    route_table("rtb-2", "10.0.0.0/16"),
+                    route_table("rtb-3", "10.0.0.0/16"),
+                ]
+            },
+            {"Filters": [{"Name": "vpc-id", "Values": ["vpc-1"]}]},
+        )
+
+        with pytest.raises(Exception, match="route tables rtb-3$"):
+            handler._add_default_routes(
+                ctx,
+                igw,
+                handler._ec2.Vpc("vpc-1"),
+                handler._ec2.InternetGateway("igw-1"),
+            )
+        stubber.assert_no_pending_responses()
+
+    assert sorted(created, key=lambda x: x["RouteTableId"]) == [
+        {
+            "RouteTableId": table_id,
+            "DestinationCidrBlock": "0.0.0.0/0",
+            "GatewayId": "igw-1",
+        }
+        for table_id in ("rtb-2", "rtb-3")
+    ]
+    errors = [log for log in ctx.logs if log.log_level == LogLevel.ERROR]
+    assert len(errors) == 1
+    assert "rtb-3" in errors[0].msg
+
+
+def test_elasticsearch_index():
+    """
+    The registered domains are described in calls of five names, a missing domain is None.
+    """
+    domains = ElasticSearchIndex.for_provider(("eu-west-1", "es", "secret"), 30)
+    client = domains.get_client("es")
+    names = [f"domain{i}" for i in range(7)]
+    for name in names:
+        domains.register(name)
+
+    def status(*names):
+        return {
+            "DomainStatusList": [
+                {
+                    "DomainId": f"id-{name}",
+                    "DomainName": name,
+                    "ARN": f"arn-{name}",
+                    "ElasticsearchClusterConfig": {},
+                }
+                for name in names
+            ]
+        }
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_elasticsearch_domains",
+            status(*names[:5]),
+            {"DomainNames": names[:5]},
+        )
+        stubber.add_response(
+            "describe_elasticsearch_domains",
+            status(names[5]),
+            {"DomainNames": names[5:]},
+        )
+
+        assert domains.get("domain0")["DomainId"] == "id-domain0"
+        assert domains.get("domain5")["DomainId"] == "id-domain5"
+        assert domains.get("domain6") is None
+        stubber.assert_no_pending_responses()
+
+
+def test_elasticsearch_update():
+    """
+    An update only sends the sections of the config that changed and is skipped while the domain is processing.
+    """
+    handler, ctx, domain = get_handler(
+        ElasticSearchHandler,
+        "aws::analytics::ElasticSearch",
+        "es-update",
+        domain_name="search",
+        instance_type="t3.small.elasticsearch",
+        instance_count=1,
+        dedicated_master_enabled=False,
+        zone_awareness_enabled=False,
+        ebs_enabled=True,
+        volume_type="gp2",
+        volume_size=20,
+        access_policies="{}",
+        automated_snapshot_start_hour=0,
+    )
+    client = handler._get_aws_client("es")
+    changes = {"volume_size": {"current": 10, "desired": 20}}
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "update_elasticsearch_domain_config",
+            {"DomainConfig": {}},
+            {
+                "DomainName": "search",
+                "EBSOptions": {
+                    "EBSEnabled": True,
+                    "VolumeType": "gp2",
+                    "VolumeSize": 20,
+                },
+            },
+        )
+        ctx.set("instance", {"Processing": False})
+        handler.update_resource(ctx, changes, domain)
+
+        ctx.set("instance", {"Processing": True})
+        with pytest.raises(SkipResource):
+            handler.update_resource(ctx, changes, domain)
+        stubber.assert_no_pending_responses()
+
+
+def test_database_index():
+    """
+    The registered databases are described with one filtered call that includes their tags.
+    """
+    databases = DatabaseIndex.for_provider(("eu-west-1", "rds", "secret"), 30)
+    client = databases.get_client("rds")
+    databases.register("db1")
+    databases.register("DB2")
+
+    with Stubber(client) as stubber:
+        stubber.add_response(
+            "describe_db_instances",
+            {
+                "DBInstances": [
+                    {
+                        "DBInstanceIdentifier": "db2",
+                        "TagList": [{"Key": "owner", "Value": "team"}],
+                    }
+                ]
+            },
+            {"Filters": [{"Name": "db-instance-id", "Values": ["db1", "db2"]}]},
+        )
+
+        assert databases.get("DB2")["TagList"] == [{"Key": "owner", "Value": "team"}]
+        assert databases.get("db1") is None
+        stubber.assert_no_pending_responses()